@@ -0,0 +1,94 @@
+"""Compare the single pass command parser with the regex expansion path it replaced.
+
+Run from the repository root: python benchmarks/bench_parser.py
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import external_module_repo
+except ImportError:
+    # main imports its package repository under this name, the bundled modules stand in for it
+    import modules
+    sys.modules['external_module_repo'] = modules
+
+import main
+import shell_parser
+
+lines = [
+    'echo hello world',
+    'echo $name has $count items',
+    'echo $a $b $c $d $e $f $g $h | grep x > /tmp/out.txt',
+    'echo ((1 + 2 * 3)); echo ((4 - 1)) >> /tmp/out.txt',
+    'cat /bin/.server/content.txt | lined',
+]
+
+
+def legacy_evaluate_expressions(computer, line):
+    # The regex driven expansion from before shell_parser, minus command substitution
+    variable_expression = re.compile(r'\$\w+')
+    arithmetic_expression = re.compile(r'\(\(\s*(.+)\s*\)\)')
+    for variable in re.findall(variable_expression, line):
+        target = computer.variables[variable]
+        if type(target) == str:
+            target = '"'+target+'"'
+        line = line.replace(variable, str(target))
+    while True:
+        findmath = re.search(arithmetic_expression, line)
+        if findmath:
+            line = line.replace(findmath.group(0), str(computer.eval_expr(findmath.group(1))))
+        else:
+            break
+    return line
+
+
+def legacy_parse(computer, line):
+    line = line.strip().split(';')
+    queued = line[1:]
+    line = legacy_evaluate_expressions(computer, line[0].strip())
+    if '|' in line:
+        line = line.split('|')
+        queued.append('|'.join(line[1:]))
+        line = line[0]
+    elif '>>' in line:
+        line = line.split('>>')[0]
+    elif '>' in line:
+        line = line.split('>')[0]
+    return line, queued
+
+
+def new_parse(computer, line):
+    sequence = shell_parser.parse(line)
+    return [[computer.expand(stage.parts) for stage in pipeline.stages] for pipeline in sequence.pipelines]
+
+
+def timeit(function, computer, repeats, clear_cache=False):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for line in lines:
+            if clear_cache:
+                shell_parser.parse.cache_clear()
+            function(computer, line)
+    return (time.perf_counter() - start) / (repeats * len(lines)) * 1e6
+
+
+def run(repeats=5000):
+    computer = main.Computer(users={'root': {'password': 'toor', 'permissions': 'root'}}, drive={'tmp': {}})
+    computer.variables.update({'$name': 'admin', '$count': 3})
+    computer.variables.update({'$'+name: name*8 for name in 'abcdefgh'})
+    results = {
+        'legacy regex path': timeit(legacy_parse, computer, repeats),
+        'shell_parser (cold cache)': timeit(new_parse, computer, repeats, clear_cache=True),
+        'shell_parser (warm cache)': timeit(new_parse, computer, repeats),
+    }
+    for name, microseconds in results.items():
+        print(f'{name:<28} {microseconds:8.2f} us/line')
+    return results
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,226 @@
+"""Benchmark suite for the interpreter hot paths, run headless through Computer.execute.
+
+Every workload is timed on its own and then run again under tracemalloc for its peak memory.
+Results are printed and saved as JSON so runs from different commits can be compared.
+
+Run from the repository root:
+    python benchmarks/run_benchmarks.py [--scale 0.2] [--only goto_loop,let] [--output FILE] [--compare OLD_FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+try:
+    import external_module_repo
+except ImportError:
+    # main imports its package repository under this name, the bundled modules stand in for it
+    import modules
+    sys.modules['external_module_repo'] = modules
+
+import main
+import local_web_network
+
+results_directory = os.path.join(repo_root, 'benchmarks', 'results')
+
+
+def make_computer(drive=None):
+    users = {'root': {'password': 'toor', 'permissions': 'root'}, 'bench': {'password': 'bench', 'permissions': 'sudo'}}
+    return main.Computer(users=users, drive=drive or {'tmp': {}}, save_location=os.devnull)
+
+
+def check(result):
+    if not result.ok:
+        raise RuntimeError(f'Benchmark commands failed: {result!r}')
+    return result
+
+
+# Each workload takes the size n, does its setup and returns (timed function, operations it performs)
+
+def goto_loop(n):
+    computer = make_computer()
+    computer.filesystem['tmp']['loop.sh'] = f'let i = 0\n:loop\nlet i = $i + 1\nif [ $i -lt {n} ] ? goto loop'
+    return lambda: check(computer.execute(['run /tmp/loop.sh'])), n
+
+
+def while_loop(n):
+    computer = make_computer()
+    computer.filesystem['tmp']['loop.sh'] = f'let i = 0\nwhile [ $i -lt {n} ]; do\n  let i = $i + 1\ndone'
+    return lambda: check(computer.execute(['run /tmp/loop.sh'])), n
+
+
+def for_loop(n):
+    computer = make_computer()
+    computer.filesystem['tmp']['loop.sh'] = f'let total = 0\nfor i in {" ".join(map(str, range(n)))}; do\n  let total = $total + $i\ndone'
+    return lambda: check(computer.execute(['run /tmp/loop.sh'])), n
+
+
+def file_tests(n):
+    computer = make_computer({'tmp': {'d': {'full.txt': 'content', 'empty.txt': ''}}})
+    tests = ['-d /tmp/d', '-e /tmp/d/full.txt', '-s /tmp/d/full.txt', '-s /tmp/d/empty.txt']
+    lines = ['let hits = 0'] + [f'if [ {tests[index % len(tests)]} ] ? let hits = $hits + 1' for index in range(n)]
+    return lambda: check(computer.execute(lines)), n
+
+
+def substitution(n):
+    # Like the message handler scripts, checking senders against a file that rarely changes
+    computer = make_computer({'tmp': {'blacklist.txt': '\n'.join(str(index) for index in range(1000, 3000))}})
+    lines = ['let hits = 0'] + [f'if [ ${{grep /tmp/blacklist.txt {index % 100}}} ] ? let hits = $hits + 1' for index in range(n)]
+    return lambda: check(computer.execute(lines)), n
+
+
+def let_arithmetic(n):
+    computer = make_computer()
+    lines = ['let x = 1'] + ['let x = ($x * 3 + 7) / 4 - 2 ** 3'] * n
+    return lambda: check(computer.execute(lines)), n
+
+
+def deep_parse_path(n):
+    depth = 40
+    drive = node = {}
+    for level in range(depth):
+        node[f'level{level}'] = {'file.txt': str(level)}
+        node = node[f'level{level}']
+    computer = make_computer(drive)
+    paths = ['/' + '/'.join(f'level{level}' for level in range(curr_depth)) + '/file.txt' for curr_depth in range(1, depth+1)]
+    relative = '/'.join(['..'] * 10 + [f'level{level}' for level in range(30, 40)]) + '/file.txt'
+
+    def work():
+        computer.cwd = paths[-1].rsplit('/', 1)[0]
+        for index in range(n):
+            computer.parse_path(paths[index % depth])
+            computer.parse_path(relative)
+    return work, n * 2
+
+
+def wildcard_cat(n):
+    computer = make_computer({'big': {f'log_{index:05}.txt': f'entry {index}' for index in range(n)}})
+    patterns = [f'/big/log_0{digit}*' for digit in range(10)] + ['/big/*.txt', '/big/log_?????.txt']
+    return lambda: check(computer.execute([f'cat {pattern}' for pattern in patterns])), len(patterns)
+
+
+def wildcard_rm(n):
+    computer = make_computer({'big': {f'log_{index:05}.txt': f'entry {index}' for index in range(n)}})
+    return lambda: check(computer.execute([f'rm /big/log_0{digit}*' for digit in range(10)] + ['rm /big/*'])), n
+
+
+def append_storm(n):
+    computer = make_computer()
+    return lambda: check(computer.execute([f'echo line {index} >> /tmp/log.txt' for index in range(n)])), n
+
+
+def long_pipeline(n):
+    computer = make_computer({'tmp': {'big.txt': '\n'.join(f'row {index} value {index * 7}' for index in range(n))}})
+    pipeline = 'cat /tmp/big.txt | grep 7 | grep 1 | cat | grep row > /tmp/out.txt'
+    return lambda: check(computer.execute([pipeline] * 5)), n * 5
+
+
+def lined_edits(n):
+    computer = make_computer()
+    commands = ['a'] + [f'line {index} of the document' for index in range(n)] + ['.', ',s/line/LINE', '1,5d', 'w /tmp/doc.txt', 'q']
+    return lambda: check(computer.execute(['lined'], inputs=commands)), len(commands)
+
+
+def read_input(n):
+    computer = make_computer()
+    return lambda: check(computer.execute(['read line'] * n, inputs=[f'input line {index}' for index in range(n)])), n
+
+
+def router_flood(n):
+    sender, recipient = make_computer(), make_computer()
+    recipient.input_capacity = None  # Nothing reads the messages, keep them all rather than dropping them
+    router = local_web_network.Router(inbox_size=n)
+    router.attach(sender)
+    address = router.attach(recipient)
+
+    def work():
+        recipient.input_stream.clear()
+        for index in range(n):
+            router.send_message(sender, address, f'message {index}')
+        router.bus.wait_until_idle()
+        router.close()
+    return work, n
+
+
+workloads = {
+    'goto_loop': (goto_loop, 20000),
+    'while_loop': (while_loop, 20000),
+    'for_loop': (for_loop, 20000),
+    'file_tests': (file_tests, 20000),
+    'substitution': (substitution, 5000),
+    'let': (let_arithmetic, 20000),
+    'deep_parse_path': (deep_parse_path, 50000),
+    'wildcard_cat': (wildcard_cat, 20000),
+    'wildcard_rm': (wildcard_rm, 20000),
+    'append_storm': (append_storm, 20000),
+    'pipeline': (long_pipeline, 20000),
+    'lined': (lined_edits, 2000),
+    'read_input': (read_input, 50000),
+    'router_flood': (router_flood, 20000),
+}
+
+
+def measure(workload, n):
+    work, operations = workload(n)
+    start = time.perf_counter()
+    work()
+    seconds = time.perf_counter() - start
+    # Memory is measured on a fresh run, tracemalloc slows everything down too much to time with it on
+    work, operations = workload(n)
+    tracemalloc.start()
+    work()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'n': n, 'operations': operations, 'seconds': seconds,
+            'ops_per_sec': operations / seconds, 'peak_memory_kb': peak / 1024}
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_root,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale=1.0, only=None, output=None, compare=None):
+    commit = current_commit()
+    report = {'commit': commit, 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'scale': scale, 'results': {}}
+    previous = {}
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['results']
+    for name, (workload, size) in workloads.items():
+        if only and name not in only:
+            continue
+        result = report['results'][name] = measure(workload, max(1, int(size * scale)))
+        line = f'{name:<16} {result["ops_per_sec"]:12.0f} ops/s {result["peak_memory_kb"]:10.0f} KB peak'
+        if name in previous:
+            line += f'   {result["ops_per_sec"] / previous[name]["ops_per_sec"]:6.2f}x ops/s vs {compare}'
+        print(line)
+    if output is None:
+        os.makedirs(results_directory, exist_ok=True)
+        output = os.path.join(results_directory, f'{commit or time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results saved to {output}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the shellsim benchmark suite.')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every workload size by this')
+    parser.add_argument('--only', help='comma separated workload names: ' + ', '.join(workloads))
+    parser.add_argument('--output', help='JSON file to save results to, defaults to benchmarks/results/COMMIT.json')
+    parser.add_argument('--compare', help='JSON results from an earlier run to compare ops/sec against')
+    arguments = parser.parse_args()
+    run(arguments.scale, arguments.only.split(',') if arguments.only else None, arguments.output, arguments.compare)
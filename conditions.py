@@ -0,0 +1,135 @@
+import functools
+
+import expressions
+import filesystem
+import shell_parser
+
+operator_words = {'-eq': '==', '-ne': '!=', '-gt': '>', '-lt': '<', '-ge': '>=', '-le': '<=', '-n': '0 <', '-z': '0 =='}
+
+file_tests = {
+    '-d': filesystem.is_dir,
+    '-e': filesystem.is_file,
+    '-s': lambda node: filesystem.is_file(node) and filesystem.size(node) > 0,
+}
+
+
+class ConditionError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=256)
+def compile_condition(condition):
+    """Compile the condition of an if or while (the text inside [ ]) into a function of the computer it is tested on.
+
+    Tests are combined with &&, || and !, grouped with ( ) written as separate words. -d, -e and -s PATH look
+    the path up directly, anything else is evaluated as an expression"""
+    words = split_words(condition)
+    test, position = parse_or(words, 0)
+    if position != len(words):
+        raise ConditionError(f'Unexpected {words[position]} in condition.')
+    return test
+
+
+def split_words(condition):
+    # Words of a condition, quoted strings and command substitutions (which can hold spaces) are kept whole
+    words = []
+    position = 0
+    while position < len(condition):
+        if condition[position].isspace():
+            position += 1
+            continue
+        start = position
+        while position < len(condition) and not condition[position].isspace():
+            close = -1
+            if condition[position] in '"\'':
+                close = condition.find(condition[position], position+1)
+            elif condition.startswith('${', position):
+                close = shell_parser.find_closing(condition, position+1, '{', '}')
+            position = max(close, position) + 1
+        words.append(condition[start:position])
+    return words
+
+
+def parse_or(words, position):
+    test, position = parse_and(words, position)
+    tests = [test]
+    while position < len(words) and words[position] == '||':
+        test, position = parse_and(words, position+1)
+        tests.append(test)
+    if len(tests) == 1:
+        return tests[0], position
+
+    def test_any(computer):
+        result = False
+        for test in tests:
+            result = test(computer)
+            if result:
+                break
+        return result
+    return test_any, position
+
+
+def parse_and(words, position):
+    test, position = parse_not(words, position)
+    tests = [test]
+    while position < len(words) and words[position] == '&&':
+        test, position = parse_not(words, position+1)
+        tests.append(test)
+    if len(tests) == 1:
+        return tests[0], position
+
+    def test_all(computer):
+        result = True
+        for test in tests:
+            result = test(computer)
+            if not result:
+                break
+        return result
+    return test_all, position
+
+
+def parse_not(words, position):
+    if position < len(words) and words[position] == '!':
+        test, position = parse_not(words, position+1)
+        return lambda computer: not test(computer), position
+    elif position < len(words) and words[position] == '(':
+        test, position = parse_or(words, position+1)
+        if position >= len(words) or words[position] != ')':
+            raise ConditionError('Missing ) in condition.')
+        return test, position+1
+    end = position
+    while end < len(words) and words[end] not in ('&&', '||', ')'):
+        end += 1
+    if end == position:
+        raise ConditionError('Missing test in condition.')
+    return build_test(words[position:end]), end
+
+
+def build_test(words):
+    if len(words) == 2 and words[0] in file_tests:
+        check = file_tests[words[0]]
+        path = words[1]
+        if path[0] in '"\'' and path[-1] == path[0]:
+            path = path[1:-1]
+        parts = shell_parser.parse_word(path)
+        if len(parts) == 1 and type(parts[0]) == str:
+            path = parts[0]
+            return lambda computer: check(computer.lookup_node(computer.normalize_path(path)))
+        return lambda computer: check(computer.lookup_node(computer.normalize_path(computer.expand(parts, quote=False))))
+    expr = ' '.join(operator_words.get(word, word) for word in words)
+    # Variables stay as slots of the compiled expression, command substitutions and arithmetic are expanded first
+    parts = shell_parser.parse_word(expr, keep_variables=True)
+    if all(type(part) == str for part in parts):
+        expr = ''.join(parts)
+        return lambda computer: evaluate(computer, expr)
+    return lambda computer: evaluate(computer, None, parts)
+
+
+def evaluate(computer, expr, parts=None):
+    # An expression that can't be evaluated is an invalid condition, not a true one
+    try:
+        if parts is not None:
+            expr = computer.expand(parts)
+        return computer.evaluate(expr)
+    except expressions.EvaluationError as e:
+        raise ConditionError(str(e))
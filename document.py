@@ -0,0 +1,124 @@
+import itertools
+
+
+class Document:
+    """Lines of a lined document, stored in blocks of a few hundred lines.
+
+    Edits copy only the block they touch. Block lengths are kept in a Fenwick tree, so finding the block
+    holding a line and updating lengths after an edit are both O(log n). Text with newlines is split
+    into lines as it is added. Indexes, insert and delete behave like they would on a list of lines."""
+    block_size = 512
+
+    def __init__(self, text=None):
+        self.blocks = []
+        self.tree = [0]  # Fenwick tree of block lengths, 1-indexed
+        self.length = 0
+        if text is not None:
+            self.insert(0, text)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def rebuild_index(self):
+        # Only needed when blocks are added or removed, which happens once every block_size lines at most
+        self.blocks = [block for block in self.blocks if block]
+        self.tree = tree = [0] * (len(self.blocks)+1)
+        for position, block in enumerate(self.blocks, 1):
+            tree[position] += len(block)
+            parent = position + (position & -position)
+            if parent < len(tree):
+                tree[parent] += tree[position]
+
+    def resize(self, block, change):
+        position = block + 1
+        while position < len(self.tree):
+            self.tree[position] += change
+            position += position & -position
+
+    def locate(self, index):
+        # Block holding line index and the line's position in it, for 0 <= index < length
+        block = 0
+        step = 1 << (len(self.tree).bit_length() - 1)
+        while step:
+            if block + step < len(self.tree) and self.tree[block+step] <= index:
+                block += step
+                index -= self.tree[block]
+            step >>= 1
+        return block, index
+
+    def normalize(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('line index out of range')
+        return index
+
+    def __getitem__(self, index):
+        block, offset = self.locate(self.normalize(index))
+        return self.blocks[block][offset]
+
+    def __setitem__(self, index, text):
+        block, offset = self.locate(self.normalize(index))
+        lines = text.split('\n')
+        self.blocks[block][offset:offset+1] = lines
+        if len(lines) > 1:
+            self.length += len(lines) - 1
+            self.resize(block, len(lines) - 1)
+            self.split_block(block)
+
+    def insert(self, index, text):
+        if index < 0:
+            index = max(0, index + self.length)
+        index = min(index, self.length)
+        lines = text.split('\n')
+        if not self.blocks:
+            self.blocks.append([])
+            self.tree.append(0)
+        if index == self.length:
+            block = len(self.blocks) - 1
+            offset = len(self.blocks[block])
+        else:
+            block, offset = self.locate(index)
+        self.blocks[block][offset:offset] = lines
+        self.length += len(lines)
+        self.resize(block, len(lines))
+        self.split_block(block)
+
+    def append(self, text):
+        self.insert(self.length, text)
+
+    def split_block(self, block):
+        lines = self.blocks[block]
+        if len(lines) > 2 * self.block_size:
+            self.blocks[block:block+1] = [lines[start:start+self.block_size] for start in range(0, len(lines), self.block_size)]
+            self.rebuild_index()
+
+    def delete(self, start, stop):
+        # Same lines as del lines[start:stop]
+        start, stop, _ = slice(start, stop).indices(self.length)
+        if start >= stop:
+            return
+        first_block, first_offset = self.locate(start)
+        last_block, last_offset = self.locate(stop-1)
+        if first_block == last_block:
+            del self.blocks[first_block][first_offset:last_offset+1]
+            self.resize(first_block, start - stop)
+            if not self.blocks[first_block]:
+                self.rebuild_index()
+        else:
+            del self.blocks[first_block][first_offset:]
+            del self.blocks[last_block][:last_offset+1]
+            del self.blocks[first_block+1:last_block]
+            self.rebuild_index()
+        self.length -= stop - start
+
+    def search(self, pattern):
+        """Indexes of the lines that the compiled pattern matches at their start"""
+        match = pattern.match
+        return [index for index, line in enumerate(self) if match(line)]
+
+    def text(self):
+        return '\n'.join(self)
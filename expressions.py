@@ -0,0 +1,127 @@
+import ast
+import functools
+import operator as op
+import re
+
+operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
+             ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor,
+             ast.USub: op.neg, ast.Not: op.not_}
+
+comparisons = {ast.Lt: op.lt, ast.LtE: op.le, ast.Gt: op.gt,
+               ast.GtE: op.ge, ast.Eq: op.eq, ast.NotEq: op.ne}
+
+permitted_functions = {'len': len, 'type': type, 'int': int}
+
+# $var slots outside of string literals are rewritten to names with this prefix before parsing
+slot_prefix = '_shellvar_'
+slot_expression = re.compile(r'("[^"]*"|\'[^\']*\')|\$(\w+)')
+
+
+class EvaluationError(Exception):
+    pass
+
+
+class VariableNotFoundError(Exception):
+    def __init__(self, variable):
+        super().__init__(variable)
+        self.variable = variable
+
+
+def rewrite_slots(expr):
+    return slot_expression.sub(lambda m: m.group(1) or slot_prefix + m.group(2), expr)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_expression(expr):
+    """Compile an expression template into a function of the computer it is evaluated on"""
+    tree = ast.parse(rewrite_slots(expr).encode('unicode_escape'), mode='eval')
+    return build(tree.body)
+
+
+def build(node):
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda computer: value
+    elif isinstance(node, ast.Name):
+        if not node.id.startswith(slot_prefix):
+            raise EvaluationError(f'Evaluation of node {ast.dump(node)} failed')
+        name = '$' + node.id[len(slot_prefix):]
+
+        def variable(computer):
+            try:
+                return computer.variables[name]
+            except KeyError:
+                raise VariableNotFoundError(name)
+        return variable
+    elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
+        function = operators[type(node.op)]
+        left = build(node.left)
+        right = build(node.right)
+        return lambda computer: function(left(computer), right(computer))
+    elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
+        function = operators[type(node.op)]
+        operand = build(node.operand)
+        return lambda computer: function(operand(computer))
+    elif isinstance(node, ast.BoolOp):
+        values = [build(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            def evaluate_and(computer):
+                result = True
+                for value in values:
+                    result = value(computer)
+                    if not result:
+                        break
+                return result
+            return evaluate_and
+        else:
+            def evaluate_or(computer):
+                result = False
+                for value in values:
+                    result = value(computer)
+                    if result:
+                        break
+                return result
+            return evaluate_or
+    elif isinstance(node, ast.Subscript):
+        value = build(node.value)
+        if isinstance(node.slice, ast.Slice):
+            lower = build(node.slice.lower) if node.slice.lower else lambda computer: None
+            upper = build(node.slice.upper) if node.slice.upper else lambda computer: None
+            return lambda computer: value(computer)[lower(computer):upper(computer)]
+        index = build(node.slice)
+        return lambda computer: value(computer)[index(computer)]
+    elif isinstance(node, ast.Compare):
+        operands = [build(node.left)] + [build(comparator) for comparator in node.comparators]
+        functions = [comparisons[type(curr_op)] for curr_op in node.ops]
+        if len(functions) == 1:
+            function, left, right = functions[0], operands[0], operands[1]
+            return lambda computer: function(left(computer), right(computer))
+
+        def evaluate_chain(computer):
+            curr_left = operands[0](computer)
+            for function, operand in zip(functions, operands[1:]):
+                curr_right = operand(computer)
+                if not function(curr_left, curr_right):
+                    return False
+                curr_left = curr_right
+            return True
+        return evaluate_chain
+    elif isinstance(node, ast.Call):
+        args = [build(arg) for arg in node.args]
+        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name) and node.func.value.id == 'self':
+            function_name = node.func.attr
+
+            def call_internal(computer):
+                if function_name in computer.permitted_internal_functions:
+                    return computer.permitted_internal_functions[function_name](*[arg(computer) for arg in args])
+            return call_internal
+        function_name = node.func.id if isinstance(node.func, ast.Name) else 'ERROR'
+
+        def call(computer):
+            argvalues = [arg(computer) for arg in args]
+            if function_name in permitted_functions:
+                return permitted_functions[function_name](*argvalues)
+            raise EvaluationError(f'Unknown function {function_name}.')
+        return call
+    else:
+        raise EvaluationError(f'Evaluation of node {ast.dump(node)} failed')
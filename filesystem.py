@@ -0,0 +1,318 @@
+import bisect
+import functools
+import json
+import re
+import threading
+import time
+
+import streams
+
+# Base filesystem images, parsed once per file and shared by every machine booted from them
+images = {}
+# ids of the directories belonging to a shared image, which are copied before a machine uses them (see thaw)
+frozen_directories = set()
+
+
+class GlobPattern:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        # Patterns without wildcards are looked up directly instead of matched against every name
+        self.literal = not any(char in pattern for char in '*?[')
+        wildcard = min([pattern.index(char) for char in '*?[' if char in pattern], default=len(pattern))
+        self.prefix = pattern[:wildcard]
+        self.match = re.compile(translate_glob(pattern)).fullmatch
+
+
+def translate_glob(pattern):
+    # * matches anything (including nothing), ? any single character, [abc] and [^abc] (or [!abc]) character sets
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+        if char == '*':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        elif char == '[':
+            curr_regex, index = translate_set(pattern, index)
+            regex.append(curr_regex)
+        else:
+            regex.append(re.escape(char))
+    return ''.join(regex)
+
+
+def translate_set(pattern, start):
+    # Regex for the character set whose members start at pattern[start] and the index after it, translated the way
+    # fnmatch does: a ] straight after [ or [! is a member, reversed ranges match nothing and a [ without a ] is literal
+    end = start
+    if pattern[end:end+1] in ('!', '^'):
+        end += 1
+    if pattern[end:end+1] == ']':
+        end += 1
+    end = pattern.find(']', end)
+    if end == -1:
+        return '\\[', start
+    members = pattern[start:end]
+    if '-' not in members:
+        members = members.replace('\\', '\\\\')
+    else:
+        chunks = []
+        position = start + 2 if pattern[start] in ('!', '^') else start + 1
+        chunk_start = start
+        while True:
+            position = pattern.find('-', position, end)
+            if position < 0:
+                break
+            chunks.append(pattern[chunk_start:position])
+            chunk_start = position + 1
+            position += 3
+        chunk = pattern[chunk_start:end]
+        if chunk:
+            chunks.append(chunk)
+        else:
+            chunks[-1] += '-'
+        for position in range(len(chunks)-1, 0, -1):
+            if chunks[position-1][-1] > chunks[position][0]:
+                chunks[position-1] = chunks[position-1][:-1] + chunks[position][1:]
+                del chunks[position]
+        # Hyphens that don't make a range and backslashes are escaped
+        members = '-'.join(chunk.replace('\\', '\\\\').replace('-', '\\-') for chunk in chunks)
+    # So Python doesn't read && ~~ || as set operations
+    members = re.sub(r'([&~|])', r'\\\1', members)
+    if not members:
+        return '(?!)', end + 1
+    elif members in ('!', '^'):
+        return '.', end + 1
+    elif members[0] in ('!', '^'):
+        return '[^' + members[1:] + ']', end + 1
+    elif members[0] == '[':
+        return '[\\' + members + ']', end + 1
+    return '[' + members + ']', end + 1
+
+
+@functools.lru_cache(maxsize=512)
+def compile_glob(pattern):
+    return GlobPattern(pattern)
+
+
+class NameIndex:
+    """Sorted names of one directory, so names starting with a prefix are found with a binary search"""
+    def __init__(self, folder):
+        self.names = sorted(folder)
+
+    def add(self, name):
+        index = bisect.bisect_left(self.names, name)
+        if index == len(self.names) or self.names[index] != name:
+            self.names.insert(index, name)
+
+    def with_prefix(self, prefix):
+        index = bisect.bisect_left(self.names, prefix)
+        while index < len(self.names) and self.names[index].startswith(prefix):
+            yield self.names[index]
+            index += 1
+
+
+class LockStripes:
+    """Fixed set of locks shared out by directory path, so changes to different directories rarely wait for each other"""
+    def __init__(self, count=64):
+        self.locks = [threading.RLock() for _ in range(count)]
+
+    def lock(self, path):
+        return self.locks[hash(path) % len(self.locks)]
+
+
+# Devices are stored as these strings in filesystem images and save files
+device_markers = {'null': '%SPECIAL_NULL_FILE%', 'random': '%SPECIAL_RANDOM_FILE%', 'process': '%SPECIAL_PROCESS_FILE%'}
+device_kinds = {marker: kind for kind, marker in device_markers.items()}
+
+
+class Dir(dict):
+    """Directory, a dict of names to nodes. Plain dicts (e.g. drives given to Computer) work as directories too"""
+    __slots__ = ('owner', 'mtime')
+
+    def __init__(self, items=(), owner='root', mtime=None):
+        super().__init__(items)
+        self.owner = owner
+        self.mtime = mtime
+
+    def copy(self):
+        return Dir(self, self.owner, self.mtime)
+
+
+class Device:
+    """Special file: 'null' discards writes, 'random' runs as a random number and 'process' starts the program of the same name"""
+    __slots__ = ('kind',)
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __str__(self):
+        return device_markers[self.kind]
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __len__(self):
+        return 0
+
+    def __eq__(self, other):
+        # Still equal to its marker string, for code written against the old string devices
+        if isinstance(other, Device):
+            return self.kind == other.kind
+        elif isinstance(other, str):
+            return device_markers[self.kind] == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(device_markers[self.kind])
+
+
+class File:
+    """File contents kept as a list of chunks, so appending doesn't copy what is already in the file.
+
+    Files read from a filesystem image (and saved files still owned by root with no mtime) are kept as plain strings."""
+    __slots__ = ('chunks', 'size', 'owner', 'mtime')
+    chunk_size = 4096  # Small appends are merged into the last chunk until it reaches this size
+
+    def __init__(self, content='', owner='root', mtime=None):
+        self.chunks = [content] if content else []
+        self.size = len(content)
+        self.owner = owner
+        self.mtime = time.time() if mtime is None else mtime
+
+    def append(self, text):
+        if self.chunks and len(self.chunks[-1]) + len(text) <= self.chunk_size:
+            self.chunks[-1] += text
+        else:
+            self.chunks.append(text)
+        self.size += len(text)
+        self.mtime = time.time()
+
+    def iter_lines(self):
+        # Works on a snapshot of the chunk list, so appends while reading don't show up half way
+        pending = []
+        for chunk in list(self.chunks):
+            start = 0
+            while True:
+                end = chunk.find('\n', start)
+                if end == -1:
+                    pending.append(chunk[start:])
+                    break
+                pending.append(chunk[start:end])
+                yield ''.join(pending)
+                pending = []
+                start = end + 1
+        yield ''.join(pending)
+
+    def __str__(self):
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, File):
+            return self.size == other.size and str(self) == str(other)
+        elif isinstance(other, str):
+            return self.size == len(other) and str(self) == other
+        return NotImplemented
+
+
+def is_file(node):
+    return isinstance(node, (str, File, Device))
+
+
+def is_dir(node):
+    return isinstance(node, dict)
+
+
+def is_device(node, kind=None):
+    return isinstance(node, Device) and (kind is None or node.kind == kind)
+
+
+def size(node):
+    # Characters in a file or entries in a directory, without reading file contents
+    if isinstance(node, File):
+        return node.size
+    return len(node)
+
+
+def iter_lines(node):
+    if isinstance(node, File):
+        return node.iter_lines()
+    return streams.iter_lines(str(node))
+
+
+def new_file(content, owner='root'):
+    """Node for content written to a file, which is a device if the content is a device marker"""
+    content = str(content)
+    if content in device_kinds:
+        return Device(device_kinds[content])
+    return File(content, owner)
+
+
+def import_node(node, owner='root', mtime=None):
+    """Filesystem node from its JSON form, as in dooros_filesystem.json. Files keep the plain string unless
+    they have an owner other than root or a modification time (as they do in save files)"""
+    if isinstance(node, str):
+        if node in device_kinds:
+            return Device(device_kinds[node])
+        return node if owner == 'root' and mtime is None else File(node, owner, mtime)
+    root = Dir(node, owner, mtime)
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        for name, child in directory.items():
+            if isinstance(child, dict):
+                child = directory[name] = Dir(child)
+                stack.append(child)
+            elif isinstance(child, str) and child in device_kinds:
+                directory[name] = Device(device_kinds[child])
+    return root
+
+
+def export_node(node):
+    """JSON form of a filesystem node, the reverse of import_node (owners and modification times are left out)"""
+    if not is_dir(node):
+        return str(node)
+    return {name: export_node(child) for name, child in node.items()}
+
+
+def owner(node):
+    # Plain string files from images and devices belong to root
+    return getattr(node, 'owner', 'root')
+
+
+def mtime(node):
+    # Seconds since the epoch, None for nodes that came from a filesystem image
+    return getattr(node, 'mtime', None)
+
+
+def load_image(location):
+    """Return the shared, read-only filesystem image stored in a JSON file, parsing it only once"""
+    try:
+        return images[location]
+    except KeyError:
+        with open(location, 'r') as f:
+            root = import_node(json.load(f))
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            frozen_directories.add(id(directory))
+            stack.extend(child for child in directory.values() if is_dir(child))
+        images[location] = root
+        return root
+
+
+def thaw(directory):
+    # Private shallow copy of a shared directory. Its files are strings so they can stay shared,
+    # and its subdirectories stay shared until they are thawed in turn.
+    if id(directory) in frozen_directories:
+        return directory.copy()
+    return directory
@@ -1,40 +1,372 @@
 from main import Computer
-import json
+import filesystem
+import streams
 import threading
+import collections
+import multiprocessing
+import queue
+import time
+
+
+class MessageBus:
+    """Delivers messages through a bounded inbox per computer, served by a fixed pool of worker threads.
+
+    A computer's messages are always handled one at a time and in order. When an inbox is full,
+    overflow='drop' drops the new message straight away while overflow='block' makes the sender
+    wait up to block_timeout seconds for space first."""
+    def __init__(self, workers=4, inbox_size=256, overflow='drop', block_timeout=1.0):
+        self.inbox_size = inbox_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.inboxes = {}
+        self.scheduled = set()  # Computers that are queued for or being served by a worker
+        self.ready = queue.Queue()
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.outstanding = 0
+        self.closed = False
+        self.counters = collections.Counter()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def post(self, computer, message):
+        with self.lock:
+            self.counters['sent'] += 1
+            if self.closed:
+                # No worker is left to deliver it
+                self.counters['dropped'] += 1
+                return False
+            inbox = self.inboxes.setdefault(computer, collections.deque())
+            if len(inbox) >= self.inbox_size:
+                self.counters['overflowed'] += 1
+                if self.overflow != 'block' or not self.space.wait_for(lambda: len(inbox) < self.inbox_size,
+                                                                        self.block_timeout):
+                    self.counters['dropped'] += 1
+                    return False
+            inbox.append(message)
+            self.outstanding += 1
+            if computer not in self.scheduled:
+                self.scheduled.add(computer)
+                self.ready.put(computer)
+        return True
+
+    def work(self):
+        while True:
+            computer = self.ready.get()
+            if computer is None:
+                return
+            while True:
+                with self.lock:
+                    inbox = self.inboxes[computer]
+                    if not inbox:
+                        self.scheduled.discard(computer)
+                        break
+                    message = inbox.popleft()
+                    self.space.notify_all()
+                try:
+                    outcome = 'delivered' if self.deliver(computer, message) else 'dropped'
+                except Exception:
+                    outcome = 'errors'
+                with self.lock:
+                    self.counters[outcome] += 1
+                    self.outstanding -= 1
+                    if not self.outstanding:
+                        self.idle.notify_all()
+
+    def deliver(self, computer, message):
+        # A computer that isn't reading its input fills it up, after which its messages are dropped
+        timeout = self.block_timeout if self.overflow == 'block' else 0
+        if 'server' not in computer.curr_processes:
+            return computer.main_context.input_stream.put(message, timeout)
+        # Handlers run in a context of their own, so they don't touch the variables and output of the shell
+        if computer.server_context is None:
+            computer.server_context = computer.new_context()
+        if not computer.server_context.input_stream.put(message, timeout):
+            return False
+        with computer.session(computer.server_context):
+            computer.do_server('respond', 'internal')
+        return True
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['queued'] = self.outstanding
+            return stats
+
+    def wait_until_idle(self, timeout=None):
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.outstanding, timeout)
+
+    def close(self):
+        # Workers finish the messages already posted, then end
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        for _ in self.workers:
+            self.ready.put(None)
+
 
 class Router:
-    def __init__(self, *connections):
-        self.connections = {}
-        i = 0
+    """Assigns addresses to the computers plugged into it and routes messages between them.
+
+    Routers can be linked to each other with link(). Each router keeps a routing table of
+    address -> (next hop router, hop count) that is filled in by distance-vector updates whenever
+    computers or links are added, so sending a message costs one table lookup per hop no matter
+    how large the network is. Addresses have to be unique across linked routers, so give each router
+    its own base_address; attach and link raise ValueError for addresses that are already in use.
+    Each router has its own MessageBus worker threads, call close() once it is no longer needed."""
+    def __init__(self, *connections, base_address=100, workers=4, inbox_size=256, overflow='drop'):
+        self.bus = MessageBus(workers=workers, inbox_size=inbox_size, overflow=overflow)
+        self.connections = {}  # Address -> computer
+        self.addresses = {}  # Computer -> address
+        self.next_address = base_address
+        self.neighbours = []
+        self.routes = {}  # Address -> (next hop router, hops) for computers on other routers
         for var in connections:
-            self.connections[100+i] = var
-            i += 1
-        print(self.connections)
-        for id in self.connections:
-            self.connections[id].curr_connections.append(self)
+            self.attach(var)
+        if connections:
+            print(self.connections)
+
+    def attach(self, computer, address=None):
+        if address is None:
+            while self.next_address in self.connections or self.next_address in self.routes:
+                self.next_address += 1
+            address = self.next_address
+            self.next_address += 1
+        elif address in self.connections or address in self.routes:
+            raise ValueError(f'Address {address} is already in use')
+        self.connections[address] = computer
+        self.addresses[computer] = address
+        computer.curr_connections.append(self)
+        self.advertise({address: 0})
+        return address
+
+    def link(self, other):
+        if other in self.neighbours:
+            return
+        # Addresses both routers know are only fine if they already lead to the same computer
+        clashes = sorted(address for address in self.known_routes().keys() & other.known_routes().keys()
+                         if self.resolve(address) is not other.resolve(address))
+        if clashes:
+            raise ValueError(f'Routers have overlapping addresses {clashes}, give them different base_address values')
+        self.neighbours.append(other)
+        other.neighbours.append(self)
+        self.advertise(self.known_routes(), [other])
+        other.advertise(other.known_routes(), [self])
+
+    def known_routes(self):
+        routes = {address: 0 for address in self.connections}
+        routes.update((address, hops) for address, (_, hops) in self.routes.items())
+        return routes
+
+    def advertise(self, routes, neighbours=None):
+        # Distance-vector propagation with a worklist, so long chains of routers don't recurse
+        pending = collections.deque((self, neighbour, routes) for neighbour in (self.neighbours if neighbours is None else neighbours))
+        while pending:
+            sender, receiver, routes = pending.popleft()
+            changed = {}
+            for address, hops in routes.items():
+                if address in receiver.connections:
+                    continue
+                known = receiver.routes.get(address)
+                if known is None or hops + 1 < known[1]:
+                    receiver.routes[address] = (sender, hops + 1)
+                    changed[address] = hops + 1
+            if changed:
+                pending.extend((receiver, neighbour, changed) for neighbour in receiver.neighbours if neighbour is not sender)
+
+    def hops(self, address):
+        if address in self.connections:
+            return 0
+        return self.routes[address][1]
+
+    def resolve(self, address):
+        # Router that address is plugged into, raising KeyError for unknown addresses
+        router = self
+        while address not in router.connections:
+            router = router.routes[address][0]
+        return router
+
+    def close(self):
+        # Stops the bus's worker threads, messages sent to this router's computers afterwards are dropped
+        self.bus.close()
 
     def send_message(self, sender, recipient, content):
-        self.connections[recipient].input_stream.append(f'MSGFROM {list(self.connections.keys())[list(self.connections.values()).index(sender)]}:{content}')
-        if 'server' in self.connections[recipient].curr_processes:
-            serverResponse = threading.Thread(target=self.connections[recipient].do_server, args=('respond', 'internal'))
-            serverResponse.start()
+        # Returns False if the recipient's inbox was full and the message was dropped
+        router = self.resolve(recipient)
+        return router.bus.post(router.connections[recipient], f'MSGFROM {self.addresses[sender]}:{content}')
 
     def query_address(self, sender):
-        return list(self.connections.keys())[list(self.connections.values()).index(sender)]
+        return self.addresses[sender]
 
     def establish_connection(self, originator, recipient, data_stream=None):
+        recipient = self.resolve(recipient).connections[recipient]
         try:
-            getattr(self.connections[recipient], 'do_slink')  # Check if recipient has slink installed
-            self.connections[recipient].input_stream=data_stream
-            return self.connections[recipient]
+            getattr(recipient, 'do_slink')  # Check if recipient has slink installed
         except AttributeError:
             return False
+        # The recipient keeps reading from the originator's stream itself, so later writes to it still arrive
+        context = recipient.main_context
+        if data_stream is None:
+            context.input_stream.clear()
+        elif isinstance(data_stream, streams.Buffer):
+            context.input_stream = data_stream
+        else:
+            context.input_stream = streams.LinkedBuffer(data_stream, context.input_stream.capacity)
+        return recipient
+
+
+class ShardRouter(Router):
+    """Router for the computers of one shard of a ShardedNetwork, running in its own process.
+
+    Messages to computers in other shards are put on that shard's queue, or counted as lost once that
+    shard has stopped. Remote computers can't be connected to directly, so establish_connection
+    returns False for them."""
+    def __init__(self, index, plan, queues, stopped, **kwargs):
+        super().__init__(**kwargs)
+        self.index = index
+        self.plan = plan  # Address -> shard index for every computer in the network
+        self.queues = queues
+        self.stopped = stopped  # Shared flags, set by each shard once it takes no more messages
+        self.forwarded = 0
+        self.lost = 0
+
+    def send_message(self, sender, recipient, content):
+        if recipient in self.connections:
+            return super().send_message(sender, recipient, content)
+        shard = self.plan[recipient]
+        with self.stopped.get_lock():
+            if self.stopped[shard]:
+                self.lost += 1
+                return False
+            self.queues[shard].put(('message', recipient, f'MSGFROM {self.addresses[sender]}:{content}'))
+        self.forwarded += 1
+        return True
+
+    def establish_connection(self, originator, recipient, data_stream=None):
+        if recipient not in self.connections:
+            self.plan[recipient]  # Unknown addresses still raise KeyError
+            return False
+        return super().establish_connection(originator, recipient, data_stream)
+
+
+def run_shard(index, specs, plan, queues, stopped, results, router_options):
+    router = ShardRouter(index, plan, queues, stopped, **router_options)
+    for address, factory, args, commands in specs:
+        computer = factory(*args)
+        router.attach(computer, address)
+        for line in commands:
+            computer.postcmd(computer.onecmd(line), line)
+    while True:
+        item = queues[index].get()
+        if item[0] == 'message':
+            router.bus.post(router.connections[item[1]], item[2])
+        elif item[0] == 'command':
+            computer = router.connections[item[1]]
+            computer.postcmd(computer.onecmd(item[2]), item[2])
+        else:
+            timeout = item[1]
+            router.bus.wait_until_idle(timeout)
+            with stopped.get_lock():
+                stopped[index] = 1
+            # Messages other shards forwarded before the flag was set are still delivered
+            while True:
+                try:
+                    item = queues[index].get(timeout=0.1)
+                except queue.Empty:
+                    break
+                if item[0] == 'message':
+                    router.bus.post(router.connections[item[1]], item[2])
+            router.bus.wait_until_idle(timeout)
+            router.close()
+            stats = router.bus.stats()
+            stats['forwarded'] = router.forwarded
+            stats['lost'] = router.lost
+            results.put((index, stats))
+            return
+
+
+class ShardedNetwork:
+    """Simulated network spread over worker processes, one Router per process.
+
+    Computers are built inside their shard by factory(*args), which (like make_basic_computer) has
+    to be a module level function, then the startup commands are run on them. Computers are
+    assigned to shards round robin and keep the same address wherever they run."""
+    def __init__(self, shards=None, base_address=100, **router_options):
+        self.shards = shards or multiprocessing.cpu_count()
+        self.next_address = base_address
+        self.router_options = router_options
+        self.specs = [[] for _ in range(self.shards)]
+        self.plan = {}
+        self.queues = []
+        self.stopped = None
+        self.processes = []
+
+    def add_computer(self, factory, *args, commands=()):
+        address = self.next_address
+        self.next_address += 1
+        shard = len(self.plan) % self.shards
+        self.plan[address] = shard
+        self.specs[shard].append((address, factory, args, list(commands)))
+        return address
+
+    def start(self):
+        self.queues = [multiprocessing.Queue() for _ in range(self.shards)]
+        self.results = multiprocessing.Queue()
+        self.stopped = multiprocessing.Array('b', self.shards)
+        for index in range(self.shards):
+            process = multiprocessing.Process(target=run_shard, daemon=True,
+                                              args=(index, self.specs[index], self.plan, self.queues, self.stopped, self.results,
+                                                    self.router_options))
+            process.start()
+            self.processes.append(process)
+
+    def send_message(self, sender_address, recipient, content):
+        # Deliver a message to a computer as if it came from sender_address
+        self.queues[self.plan[recipient]].put(('message', recipient, f'MSGFROM {sender_address}:{content}'))
+
+    def run_command(self, address, line):
+        self.queues[self.plan[address]].put(('command', address, line))
+
+    def stop(self, timeout=5):
+        """Let every shard finish the messages it has queued, then shut the workers down and return their counters.
+        Raises RuntimeError if a shard died (e.g. its factory raised) or hasn't reported back in time"""
+        for curr_queue in self.queues:
+            curr_queue.put(('stop', timeout))
+        stats = {}
+        # Shards wait up to timeout for their own messages, then for any forwarded while they were stopping
+        deadline = time.monotonic() + 2 * timeout + 5
+        try:
+            while len(stats) < len(self.processes):
+                try:
+                    index, shard_stats = self.results.get(timeout=0.5)
+                    stats[index] = shard_stats
+                    continue
+                except queue.Empty:
+                    pass
+                for index, process in enumerate(self.processes):
+                    if index not in stats and process.exitcode not in (None, 0):
+                        raise RuntimeError(f'Shard {index} exited with code {process.exitcode} before reporting its counters')
+                if time.monotonic() > deadline:
+                    missing = sorted(set(range(len(self.processes))) - set(stats))
+                    raise RuntimeError(f'Shards {missing} did not stop within {timeout} seconds')
+        finally:
+            for process in self.processes:
+                if process.is_alive() and len(stats) < len(self.processes):
+                    process.terminate()
+                process.join()
+            self.processes = []
+        return stats
 
 
 def make_basic_computer(name, pwd, extra_files):
     users = {'root': {'password': 'toor', 'permissions': 'root'}, name: {'password': pwd, 'permissions': 'sudo'}}
-    with open('dooros_filesystem.json', 'r') as f:
-        file_system = json.load(f)
+    # Only the directories on the way to the new home directory are copied, the rest of the image is shared
+    file_system = filesystem.thaw(filesystem.load_image('dooros_filesystem.json'))
+    file_system['users'] = filesystem.thaw(file_system['users'])
     file_system['users'][name] = extra_files
     return Computer(users=users, drive=file_system, save_location=f'{name}_{pwd}_computer.save')
 
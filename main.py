@@ -1,43 +1,184 @@
 import cmd
+import contextlib
+import threading
 import time
 import random
 import re
 import types
 import external_module_repo
-import ast
-import operator as op
-import json
 import os
-import pickle
+import scripting
+import shell_parser
+import filesystem
+import streams
+import itertools
+import expressions
+import collections
+import persistence
+import profiling
+import search
+import conditions
+from document import Document
+from concurrent.futures import ThreadPoolExecutor
 
-try:
-    import sqlitedict
-except ImportError:
-    os.system('pip3 install sqlitedict')
-    import sqlitedict
 
+class Result:
+    """Captured outcome of Computer.execute"""
+    def __init__(self):
+        self.stdout_lines = []
+        self.stderr_lines = []
+        # One entry per command line run, including the lines of scripts it runs: 0 or an error code
+        self.exit_codes = []
+        self.exit_code = 0  # First error code, or 0 if every command succeeded
 
-operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
-             ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor,
-             ast.USub: op.neg, ast.Not: op.not_}
+    @property
+    def stdout(self):
+        return '\n'.join(self.stdout_lines)
+
+    @property
+    def stderr(self):
+        return '\n'.join(self.stderr_lines)
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+    def record(self, code):
+        code = code or 0
+        self.exit_codes.append(code)
+        if code and not self.exit_code:
+            self.exit_code = code
+
+    def __repr__(self):
+        return f'Result(exit_code={self.exit_code!r}, stdout={self.stdout!r}, stderr={self.stderr!r})'
+
+
+class InputExhaustedError(Exception):
+    """Raised by request_input when execute has run out of inputs, ending the command with NO_INPUT_ERROR"""
+
+
+class CommandCache:
+    """Output of read-only command substitutions, shared by a computer and its sub-contexts.
+
+    generation counts filesystem changes (see Computer.node_changed), output cached in an earlier generation is stale"""
+    def __init__(self, size=256):
+        self.entries = collections.OrderedDict()  # (cwd, command line) -> (generation, output, stdout lines, stderr lines)
+        self.size = size
+        self.generation = 0
+        self.lock = threading.Lock()  # Substitutions run on several threads at once, see prefetch_substitutions
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != self.generation:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1:]
+
+    def put(self, key, generation, result):
+        # Output of a command that ran before a file changed is dropped rather than cached as current
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (generation,) + result
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
+
+class ExecutionContext:
+    """State of one session running commands on a Computer: its output, input, variables, user and working directory.
+
+    Commands run in the context bound to their thread with Computer.session, or in the computer's main context.
+    Sessions in different threads share the filesystem and caches but nothing else."""
+    def __init__(self, variables=None, curr_user='root', cwd='/', input_capacity=1024):
+        self.output = None
+        self.redirect_output = False
+        self.output_buffer = streams.Buffer()
+        self.pipe_buffer = []
+        self.pipe_input = None
+        self.script_input = None  # Piped input of the running script, read by read and lined
+        self.output_mode = 'echo'
+        self.output_location = None
+        # Lines waiting to be read by request_input. Messages from routers wait for space once it holds input_capacity lines
+        self.input_stream = streams.Buffer(capacity=input_capacity)
+        self.cmdqueue = streams.Buffer()  # Commands queued by if, run before the next prompt
+        self.capture = None  # Result being filled in by execute, None when attached to a terminal
+        self.variables = {} if variables is None else variables
+        self.curr_user = curr_user
+        self.cwd = cwd
+
+    def child(self):
+        # For command substitutions: the same input, user and capture, a copy of the variables and output of its own
+        context = ExecutionContext(dict(self.variables), self.curr_user, self.cwd)
+        context.input_stream = self.input_stream
+        context.cmdqueue = self.cmdqueue
+        context.script_input = self.script_input
+        context.capture = self.capture
+        return context
+
+
+class Sessions(threading.local):
+    context = None  # Context bound with Computer.session in this thread
+
+
+def context_attribute(name):
+    def get(self):
+        return getattr(self.sessions.context or self.main_context, name)
+
+    def set(self, value):
+        setattr(self.sessions.context or self.main_context, name, value)
+    return property(get, set)
 
-permitted_functions = {'len': len, 'type': type, 'int': int}
 
 class Computer(cmd.Cmd):
+    # Execution state is kept in the ExecutionContext of the session running a command
+    output = context_attribute('output')
+    redirect_output = context_attribute('redirect_output')
+    output_buffer = context_attribute('output_buffer')
+    pipe_buffer = context_attribute('pipe_buffer')
+    pipe_input = context_attribute('pipe_input')
+    script_input = context_attribute('script_input')
+    output_mode = context_attribute('output_mode')
+    output_location = context_attribute('output_location')
+    input_stream = context_attribute('input_stream')
+    cmdqueue = context_attribute('cmdqueue')
+    capture = context_attribute('capture')
+    variables = context_attribute('variables')
+    curr_user = context_attribute('curr_user')
+    cwd = context_attribute('cwd')
+
     def __init__(self, users=None, drive=None, save_location="main_save.save"):
+            self.main_context = ExecutionContext()
+            self.server_context = None  # Context that router messages are handled in while the server runs
+            self.sessions = Sessions()  # Context bound to each thread by session
             self.name = 'DoorOSMachine'
             self.specs = {'OS': 'doorOS==3.1', 'defender': None}
 
-            if not drive:
-                with open('dooros_filesystem.json', 'r') as f:
-                    self.filesystem = json.load(f)
-            else:
-                self.filesystem = drive
+            if drive is None:
+                drive = filesystem.load_image('dooros_filesystem.json')
+            elif type(drive) == dict:
+                # Drives given as plain JSON style dicts get Dir and Device nodes
+                drive = filesystem.import_node(drive)
+            # Directories of a shared base image are copied the first time this machine resolves them
+            self.filesystem = filesystem.thaw(drive)
+            # Normalized absolute path -> directory, see parse_path
+            self.path_cache = {'/': self.filesystem}
+            # Directory path -> sorted names, built on demand for prefix globs, see find_file
+            self.name_indexes = {}
+            # Directory path -> search.TrigramIndex, built by grep when grep_indexing is on
+            self.grep_indexes = {}
+            self.grep_indexing = False
+            # Words in file paths and contents, for locate and search
+            self.search_index = search.SearchIndex()
+            self.search_index_saved = False  # Whether the save file holds an up to date copy of the index
+            self.filesystem_lock = threading.RLock()  # Held while directories are thawed or loaded from the save file
+            self.directory_locks = filesystem.LockStripes()  # Held while a directory's contents are changed
             self.speed = 0.1
             self.save_location = save_location
-
-            # Current working directory path and directory contents
-            self.cwd = '/'
+            # Nothing is on disk yet, so the first checkpoint writes the whole tree
+            self.store = persistence.Store(save_location)
+            self.store.mark_dirty('/')
+            self.checkpoint_interval = None  # Seconds between automatic saves, None to only save on shutdown
+            self.last_checkpoint = time.time()
 
             # Current users
             if not users:
@@ -48,115 +189,141 @@ class Computer(cmd.Cmd):
                               user_name: {'password': password, 'permissions': 'sudo'}}
             else:
                 self.users = users
-            self.curr_user = 'root'
             self.prompt = '(INVALID ACCESS) '
 
             # System variables
             self.forbidden_chars = ['/', ' ', '>', '*', '\\', '?', '{', '}']
             self.null_output = 'NUL'
-            self.variables = {}
-            self.permitted_internal_functions = {'parse_path': self.parse_path}
-            self.permitted_internal_variables = ['complex_commands']
+            self.permitted_internal_functions = {'parse_path': self.parse_path, 'is_file': filesystem.is_file, 'is_dir': filesystem.is_dir}
+            self.permitted_internal_variables = ['complex_commands', 'checkpoint_interval', 'grep_indexing', 'input_capacity',
+                                                'cacheable_commands', 'substitution_workers']
             self.complex_commands = ['lined']  # For these commands, don't split arguments
+            self.streaming_commands = ['cat', 'grep', 'echo', 'read', 'lined', 'run']  # These read piped input line by line
+            # Command substitutions of these commands are cached until a file changes, see substitute
+            self.cacheable_commands = ['cat', 'grep', 'ls', 'pwd']
+            self.command_cache = CommandCache()
+            self.substitution_lock = threading.Lock()
+            self.substitution_pool = None  # Started by prefetch_substitutions when it is first needed
+            self.substitution_workers = 0  # Threads running a line's read-only substitutions together, 0 to run them in turn
             self.curr_processes = ['shell']
             self.curr_connections = []
-
-            # Stdio
-            self.output = None
-            self.redirect_output = False
-            self.output_buffer = []
-            self.output_mode = 'echo'
-            self.output_location = None
-            self.input_stream = []
+            self.profiler = None  # profiling.Profiler while stats are being collected, see do_stats
             super().__init__()
+            self.cmdqueue = streams.Buffer()  # cmd.Cmd sets a list
+
+    @property
+    def context(self):
+        return self.sessions.context or self.main_context
+
+    @contextlib.contextmanager
+    def session(self, context):
+        """Run the commands of this thread in context until the with block ends"""
+        outer = self.sessions.context
+        self.sessions.context = context
+        try:
+            yield context
+        finally:
+            self.sessions.context = outer
+
+    def new_context(self):
+        """Context for a new session, starting as the main context's user in its working directory"""
+        main = self.main_context
+        return ExecutionContext(curr_user=main.curr_user, cwd=main.cwd, input_capacity=main.input_stream.capacity)
+
+    def directory_lock(self, path):
+        return self.directory_locks.lock(self.normalize_path(path))
+
+    @property
+    def input_capacity(self):
+        return self.input_stream.capacity
+
+    @input_capacity.setter
+    def input_capacity(self, capacity):
+        self.input_stream.capacity = capacity
+
+    @property
+    def substitution_workers(self):
+        return self.substitution_pool_size
+
+    @substitution_workers.setter
+    def substitution_workers(self, workers):
+        # The old pool's threads end once they finish what they are running, a pool of the new size starts when needed
+        with self.substitution_lock:
+            self.substitution_pool_size = workers
+            if self.substitution_pool is not None:
+                self.substitution_pool.shutdown(wait=False)
+                self.substitution_pool = None
 
     def emptyline(self):
         return
 
+    def evaluate(self, expr):
+        # $var slots in expr are looked up in self.variables when the compiled expression runs. Raises
+        # expressions.VariableNotFoundError, and expressions.EvaluationError for anything else that goes wrong
+        try:
+            compiled = expressions.compile_expression(expr)
+        except (expressions.EvaluationError, SyntaxError, ValueError):
+            raise expressions.EvaluationError(f'Cannot evaluate {expr}.')
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(f'(( {expr} ))')
+        try:
+            return compiled(self)
+        except (expressions.VariableNotFoundError, expressions.EvaluationError):
+            raise
+        except Exception as e:
+            raise expressions.EvaluationError(f'Cannot evaluate {expr} ({type(e).__name__}: {e}).')
+        finally:
+            if profiler is not None:
+                profiler.exit()
+
     def eval_expr(self, expr):
-        return self.eval_(ast.parse(expr.encode('unicode_escape'), mode='eval').body)
-
-    def eval_(self, node):
-        if isinstance(node, ast.Num):  # <number>
-            return node.n
-        elif isinstance(node, ast.Constant):
-            return node.value
-        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-            return operators[type(node.op)](self.eval_(node.left), self.eval_(node.right))
-        elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-            return operators[type(node.op)](self.eval_(node.operand))
-        elif isinstance(node, ast.Slice):
-            if node.lower:
-                lower = self.eval_(node.lower)
-            else:
-                lower = 0
-            if node.upper:
-                upper = self.eval_(node.upper)
-            else:
-                upper = '$'
-            return [lower, upper]
-        elif isinstance(node, ast.Subscript):
-            root_string = self.eval_(node.value)
-            target_range = self.eval_(node.slice)
-            if type(target_range) == int:
-                return root_string[target_range]
-            elif type(target_range) == list:
-                if target_range[1] != '$':
-                    return root_string[target_range[0]:target_range[1]]
-                else:
-                    return root_string[target_range[0]:]
-        elif isinstance(node, ast.Compare):
-            curr_left = self.eval_(node.left)
-            if len(node.ops) == 1:
-                curr_right = self.eval_(node.comparators[0])
-            else:
-                curr_right = self.eval_(ast.Compare(left=node.comparators[0], ops=node.ops[1:], comparators=node.comparators[1:]))
-                if curr_right == False:
-                    return False
-                else:
-                    curr_right = self.eval_(node.comparators[1])
-            curr_op = node.ops[0]
-            if isinstance(curr_op, ast.Lt):
-                return curr_left < curr_right
-            elif isinstance(curr_op, ast.LtE):
-                return curr_left <= curr_right
-            elif isinstance(curr_op, ast.Gt):
-                return curr_left > curr_right
-            elif isinstance(curr_op, ast.GtE):
-                return curr_left >= curr_right
-            elif isinstance(curr_op, ast.Eq):
-                return curr_left == curr_right
-            elif isinstance(curr_op, ast.NotEq):
-                return curr_left != curr_right
-        elif isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name):
-                function_namespace = 'foreign'
-                function_name = node.func.id
-            elif isinstance(node.func, ast.Attribute):
-                function_namespace = node.func.value.id
-                function_name = node.func.attr
-            else:
-                function_namespace = 'INVALID'
-                function_name = 'ERROR'
-            argvalues = []
-            for arg in node.args:
-                argvalues.append(self.eval_(arg))
-            if function_namespace == 'self':
-                if function_name in self.permitted_internal_functions:
-                    return self.permitted_internal_functions[function_name](*argvalues)
-            else:
-                if function_name in permitted_functions:
-                    return permitted_functions[function_name](*argvalues)
-                print(f'Unknown function {function_name} detected.')
-                return 'EVALUATION_ERROR'
+        # Like evaluate, but errors other than missing variables are reported and give EVALUATION_ERROR
+        try:
+            return self.evaluate(expr)
+        except expressions.EvaluationError as e:
+            self.write_error(f'Error - {e}')
+            return 'EVALUATION_ERROR'
+
+    def write(self, text):
+        # All terminal output goes through write and write_error, so execute can capture it
+        if self.capture is None:
+            print(text)
+        else:
+            self.capture.stdout_lines.append(str(text))
+
+    def write_error(self, text):
+        if self.capture is None:
+            print(text)
         else:
-            ast.dump(node)
-            print(f'Evaluation of node {ast.dump(node)} failed')
-            raise TypeError(node)
+            self.capture.stderr_lines.append(str(text))
+
+    def execute(self, commands, inputs=(), context=None):
+        """Run a script (a string, with labels, goto and if like a script file) or a list of command lines
+        without the terminal: nothing is printed, nothing sleeps and input only comes from inputs.
+        Commands run in context if one is given (see new_context), so several threads can run commands at once.
+        Returns a Result with the captured output and exit codes."""
+        if context is not None:
+            with self.session(context):
+                return self.execute(commands, inputs)
+        if type(commands) != str:
+            commands = '\n'.join(commands)
+        outer_capture, outer_input = self.capture, self.input_stream
+        self.capture = result = Result()
+        self.input_stream = streams.Buffer(inputs, capacity=outer_input.capacity)
+        try:
+            error_code = self.run_program(scripting.get_program(commands), 'execute')
+            if error_code:
+                result.record(error_code)
+        finally:
+            outer_input.capacity = self.input_stream.capacity  # In case the commands changed input_capacity
+            self.capture, self.input_stream = outer_capture, outer_input
+        return result
 
     def delay_print(self, *args):
-        print(' '.join(args))
-        time.sleep(self.speed)
+        self.write(' '.join(args))
+        if self.capture is None:
+            time.sleep(self.speed)
 
     def check_invalid_name(self, string):
         if True in [True for char in self.forbidden_chars if char in string]:
@@ -171,180 +338,387 @@ class Computer(cmd.Cmd):
             try:
                 if password == self.users[username]['password']:
                     if username == 'root':
-                        print('Error - Cannot login as root. Please try again.')
+                        self.write_error('Error - Cannot login as root. Please try again.')
                         continue
                     self.curr_user = username
                     break
             except KeyError:
-                print('Invalid username or password. Please try again.')
+                self.write_error('Invalid username or password. Please try again.')
         self.prompt = f'{self.curr_user}@{self.name} $ '
         self.cmdloop()
 
-    def evaluate_expressions(self, line: str, force_evaluate=False):
-        variable_expression = re.compile(r'\$\w+')
-        internal_code_expression = re.compile(r'\${([^}]+)}')
-        arithmetic_expression = re.compile(r'\(\(\s*(.+)\s*\)\)')
-        while re.search(internal_code_expression, line):
-            internal_line = re.search(internal_code_expression, line)
-            self.onecmd(internal_line.group(1))
-            if type(self.output) == str:
-                output = '"'+self.output+'"'
-            else:
-                output = str(self.output)
-            line = line.replace(internal_line.group(0), output)
-            self.output = None
-        for variable in re.findall(variable_expression, line):
-            try:
-                target = self.variables[variable]
-                if type(target) == str:
-                    target = '"'+target+'"'
-                line = line.replace(variable, str(target))
-            except KeyError:
-                print(f'Error - Variable {variable} not found.')
-                return self.error_break('VARIABLE_NOT_FOUND_ERROR')
-        while True:
-            findmath = re.search(arithmetic_expression, line)
-            if findmath:
+    def expand(self, parts, quote=True):
+        # Strings from variables and command substitutions are quoted unless quote is False
+        pieces = []
+        prefetched = self.prefetch_substitutions(parts) if self.substitution_workers else None
+        for part in parts:
+            if type(part) == str:
+                pieces.append(part)
+            elif part.kind == 'variable':
                 try:
-                    line = line.replace(findmath.group(0), str(self.eval_expr(findmath.group(1))))
-                except KeyboardInterrupt:
-                    print(f'Error - Evaluation of expression {findmath.group(1)} failed.')
-                    return self.error_break('EVALUATION_ERROR')
+                    target = self.variables[part.text]
+                except KeyError:
+                    raise expressions.VariableNotFoundError(part.text)
+                pieces.append('"'+target+'"' if quote and type(target) == str else str(target))
+            elif part.kind == 'command':
+                output = self.substitute(part.text, prefetched)
+                pieces.append('"'+output+'"' if quote and type(output) == str else str(output))
             else:
-                break
-        if force_evaluate:
-            return self.eval_expr(line)
+                pieces.append(str(self.evaluate(part.text)))
+        return ''.join(pieces)
+
+    def sub_context(self):
+        """Context for running a command substitution. It has the input and user of the current context, but its own
+        output, variables and working directory, so the command can't change them here"""
+        return self.context.child()
+
+    def substitute(self, command, prefetched=None):
+        # Output of ${command}
+        if prefetched and command in prefetched:
+            line, generation, error_code, result = prefetched[command]
         else:
-            return line
+            line = self.cacheable_line(command)
+            if line is None:
+                with self.session(self.sub_context()) as context:
+                    self.onecmd(command)
+                return streams.join(context.output)
+            generation = error_code = result = None
+        if result is None:
+            result = self.command_cache.get((self.cwd, line))
+        if result is None:
+            generation = self.command_cache.generation
+            error_code, result = self.run_read_only(line)
+        if generation is not None and not error_code:
+            self.command_cache.put((self.cwd, line), generation, result)
+        output, stdout_lines, stderr_lines = result
+        # Whatever the command printed is printed again when its output comes from the cache
+        for text in stdout_lines:
+            self.write(text)
+        for text in stderr_lines:
+            self.write_error(text)
+        return output
+
+    def cacheable_line(self, command):
+        # Expanded command line if command is one read-only command with cacheable output, otherwise None
+        sequence = shell_parser.parse(command)
+        if len(sequence.pipelines) != 1 or len(sequence.pipelines[0].stages) != 1:
+            return None
+        stage = sequence.pipelines[0].stages[0]
+        if stage.redirect or stage.name not in self.cacheable_commands:
+            return None
+        return self.expand(stage.parts)
+
+    def run_read_only(self, line, context=None):
+        """Run a read-only command line in a sub-context, returning its error code and (output, stdout lines, stderr lines)"""
+        context = context or self.sub_context()
+        context.capture = Result()
+        with self.session(context):
+            error_code = self.dispatch(line)
+        return error_code, (streams.join(context.output), tuple(context.capture.stdout_lines), tuple(context.capture.stderr_lines))
+
+    def prefetch_substitutions(self, parts):
+        # Runs the read-only substitutions of a line that aren't cached together on the thread pool.
+        # Returns command -> (line, generation, error code, result) for substitute, result is None if it didn't run.
+        prefetched = {}
+        for part in parts:
+            if type(part) != str and part.kind == 'command' and part.text not in prefetched:
+                line = self.cacheable_line(part.text)
+                if line is not None:
+                    prefetched[part.text] = (line, None, None, None)
+        commands = [command for command, entry in prefetched.items() if self.command_cache.get((self.cwd, entry[0])) is None]
+        if len(commands) < 2 or self.profiler is not None:
+            return prefetched
+        generation = self.command_cache.generation
+        with self.substitution_lock:
+            if not self.substitution_pool_size:
+                return prefetched
+            if self.substitution_pool is None:
+                self.substitution_pool = ThreadPoolExecutor(self.substitution_pool_size)
+            futures = [self.substitution_pool.submit(self.run_read_only, prefetched[command][0], self.sub_context())
+                       for command in commands]
+        for command, future in zip(commands, futures):
+            prefetched[command] = (prefetched[command][0], generation) + future.result()
+        return prefetched
 
-    def parseline(self, line: str):
-        line = line.strip()
-        preline = ''
-        if line.startswith('raw'):
-            skiparea = re.search(r'"(.+)"', line)
-            if skiparea:
-                preline = line.split(skiparea.group(0))[0]+skiparea.group(1)
-                line = line.split(skiparea.group(0))[1]
-        line = line.split(';')
-        self.cmdqueue += line[1:]
-        line = line[0].strip()
-        line = self.evaluate_expressions(line)
-        if not line.startswith('let'):
-            if '|' in line:
-                line = line.split('|')
-                self.cmdqueue.append('|'.join(line[1:]))
-                self.output_mode = 'pipe'
-                line = line[0]
-            # Streaming output to file is always the last thing so its ok to check it after checking for pipes?
-            elif '>>' in line:
-                line = line.split('>>')
-                self.output_mode = 'file'
-                self.output_location = line[1].strip()
-                line = line[0]
-            elif '>' in line:
-                line = line.split('>')
-                self.output_mode = 'file_overwrite'
-                self.output_location = line[1].strip()
-                line = line[0]
-        return super().parseline(preline+line)
+    def onecmd(self, line):
+        # Lines are parsed once into a tree of pipelines (cached by line), then run stage by stage
+        sequence = shell_parser.parse(line)
+        last = len(sequence.pipelines) - 1
+        for index, pipeline in enumerate(sequence.pipelines):
+            stop = self.run_pipeline(pipeline)
+            if index < last:
+                if type(stop) == str and (stop.endswith('ERROR') or stop == 'EXIT'):
+                    return stop
+                self.postcmd(stop, line)
+        return stop
+
+    def run_pipeline(self, pipeline):
+        context = self.context
+        initial_mode = context.output_mode
+        outer_input = context.pipe_input
+        piped_output = None
+        last = len(pipeline.stages) - 1
+        try:
+            for index, stage in enumerate(pipeline.stages):
+                try:
+                    line = self.expand(stage.parts)
+                    if stage.redirect:
+                        location = self.expand(stage.redirect.target)
+                except expressions.VariableNotFoundError as e:
+                    self.write_error(f'Error - Variable {e.variable} not found.')
+                    return 'VARIABLE_NOT_FOUND_ERROR'
+                except expressions.EvaluationError as e:
+                    self.write_error(f'Error - {e}')
+                    return 'EVALUATION_ERROR'
+                # Streaming commands pull lines from the previous stage as they need them
+                context.pipe_input = None
+                if index > 0:
+                    if stage.name in self.streaming_commands:
+                        context.pipe_input = piped_output
+                    else:
+                        line = self.pass_piped_output(stage.name, line, list(piped_output))
+                if stage.redirect:
+                    context.output_mode = stage.redirect.mode
+                    context.output_location = location
+                elif index < last:
+                    context.output_mode = 'pipe'
+                    context.pipe_buffer = []
+                else:
+                    context.output_mode = initial_mode if not last else 'echo'
+                stop = self.dispatch(line)
+                if type(stop) == str and (stop.endswith('ERROR') or stop == 'EXIT'):
+                    return stop
+                if index < last:
+                    if context.output:
+                        self.flush()
+                    piped_output = streams.chain_lines(context.pipe_buffer)
+                    context.pipe_buffer = []
+                    context.output_mode = 'echo'
+            return stop
+        finally:
+            context.pipe_input = outer_input
+
+    def dispatch(self, line):
+        profiler = self.profiler
+        try:
+            if profiler is None:
+                return super().onecmd(line)
+            profiler.last_command = line.split(' ', 1)[0]
+            profiler.enter(profiler.last_command)
+            try:
+                return super().onecmd(line)
+            finally:
+                profiler.exit()
+        except InputExhaustedError:
+            return 'NO_INPUT_ERROR'
+
+    def default(self, line):
+        self.write_error(f'Error - Unknown command {line.split()[0]}.')
+        return 'UNKNOWN_COMMAND_ERROR'
+
+    def do_help(self, arg):
+        """List available commands with "help" or detailed help with "help cmd"."""
+        if self.capture is None:
+            return super().do_help(arg)
+        # cmd.Cmd prints help straight to stdout, so execute gets the same text through write
+        if arg:
+            command = getattr(self, 'do_' + arg, None)
+            if command is None or not command.__doc__:
+                self.write_error(f'Error - No help on {arg}.')
+                return 'NO_HELP_ERROR'
+            self.write(command.__doc__)
+        else:
+            self.write(self.doc_header)
+            self.write(' '.join(sorted(name[3:] for name in self.get_names() if name.startswith('do_') and getattr(self, name).__doc__)))
+
+    def pass_piped_output(self, name, line, output):
+        # Newlines are the dividers for primitive stdin implementation as well as argument dividing
+        if not output:
+            return line
+        elif name == 'run' or name == 'read':
+            self.input_stream += output
+            return line
+        elif name in self.complex_commands:
+            return line + ' ' + '\n'.join(output)
+        else:
+            return line + ' ' + ' '.join(output)
 
     def request_input(self, prompt='Enter input'):
-        if not self.input_stream:
-            return input(prompt)
+        context = self.context
+        if context.input_stream:
+            return context.input_stream.popleft()
+        for source in (context.pipe_input, context.script_input):
+            if source is not None:
+                for line in source:
+                    return line
+        if context.capture is not None:
+            self.write_error('Error - No input available.')
+            raise InputExhaustedError
+        return input(prompt)
+
+    def emit(self, blocks):
+        # Inside a pipeline output is handed on lazily line by line, everywhere else it is a plain string
+        if self.output_mode == 'pipe':
+            self.output = streams.chain_lines(blocks)
         else:
-            return self.input_stream.pop(0)
+            self.output = '\n'.join([str(block) for block in blocks])
 
     def error_break(self, error_code='ERROR'):
         # Just halt everything, make sure errors don't propagate
-        self.cmdqueue = []
+        self.cmdqueue.clear()
         self.output_mode = 'echo'
         self.output_location = None
-        self.input_stream = []
+        self.input_stream.clear()
         self.output = f'Process terminated with error code {error_code}'
         return error_code
 
     def save(self):
-        with open(self.save_location, 'wb') as f:
-            pickle.dump(self, f)
+        # Sessions with a checkpoint_interval save from their own threads, one at a time. The filesystem lock is
+        # always taken before the store's, as parse_path holds it while loading directories from the store
+        with self.filesystem_lock, self.store.lock:
+            index = self.search_index
+            if not index.ready and index.stale and self.search_index_saved and '/' not in self.store.dirty:
+                index.load(self.store.load_search_rows())
+            if index.ready:
+                index.refresh(self.lookup_node, self.store.hydrate)
+                if '/' in self.store.dirty:
+                    # The whole save file is rewritten, index rows included
+                    index.changed.update(index.files)
+                search_rows = index.take_changes()
+            else:
+                # Nothing to keep up to date, the drive is indexed when it is first searched
+                index.stale.clear()
+                search_rows = []
+            self.search_index_saved = index.ready or (self.search_index_saved and '/' not in self.store.dirty)
+            main = self.main_context
+            self.store.checkpoint(self.lookup_node, dict(self.users), dict(main.variables),
+                                  {'name': self.name, 'cwd': main.cwd, 'search_index': self.search_index_saved}, search_rows)
+            self.last_checkpoint = time.time()
+
+    def refresh_search_index(self):
+        index = self.search_index
+        with self.filesystem_lock, self.store.lock:
+            if not index.ready:
+                if self.search_index_saved:
+                    index.load(self.store.load_search_rows())
+                else:
+                    index.build()
+            index.refresh(self.lookup_node, self.store.hydrate)
+        return index
+
+    @classmethod
+    def load(cls, save_location):
+        # Only the users and the top level of the filesystem are read now, directories load as they are visited
+        store = persistence.Store(save_location)
+        root = store.lazy_directory('/')
+        store.hydrate(root)
+        computer = cls(users=store.load_users(), drive=root, save_location=save_location)
+        computer.store = store
+        computer.variables = store.load_variables()
+        meta = store.load_meta()
+        computer.name = meta.get('name', computer.name)
+        computer.cwd = meta.get('cwd', computer.cwd)
+        computer.search_index_saved = meta.get('search_index', False)
+        return computer
 
     def flush(self):
-        # If there is output either print it, add it to the next command in the command queue,
+        # If there is output either print it, pass it on to the next stage of the pipeline,
         # or stream it to a file
+        if self.profiler is not None:
+            if streams.is_stream(self.output):
+                self.output = self.profiler.count_stream(self.output)
+            else:
+                self.profiler.add_output(len(str(self.output).encode()))
         if self.output_mode == 'echo':
+            if streams.is_stream(self.output):
+                self.output = streams.join(self.output)
             if not self.redirect_output:
-                print(self.output)
+                self.write(self.output)
             else:
                 self.output_buffer.append(self.output)
             self.output = None
         elif self.output_mode == 'pipe':
-            next_commands = [_.strip() for _ in self.cmdqueue[0].split('|')]
-            # Newlines are the dividers for primitive stdin implementation as well as argument dividing
-            if next_commands[0].startswith('run') or next_commands[0].startswith('read'):
-                self.input_stream += self.output.split('\n')
-            else:
-                if not True in [True for _ in self.complex_commands if next_commands[0].startswith(_)]:
-                    added_arguments = ' '.join(self.output.split('\n'))
-                else:
-                    added_arguments = self.output
-                if '>' in next_commands[0]:
-                    target_split = next_commands[0].split('>')
-                    next_commands[0] = target_split[0] + ' ' + added_arguments + '>' + target_split[1]
-                elif '>>' in next_commands[0]:
-                    target_split = next_commands[0].split('>>')
-                    next_commands[0] = target_split[0] + ' ' + added_arguments + '>>' + target_split[1]
-                else:
-                    next_commands[0] = next_commands[0] + ' ' + added_arguments
-            self.cmdqueue[0] = '|'.join([next_commands[0]] + next_commands[1:])
+            # Handed on to the next stage once the current stage of the pipeline finishes
+            self.pipe_buffer.append(self.output)
             self.output = None
         elif self.output_mode == 'file' or self.output_mode == 'file_overwrite':
-            file_path = '/'.join(self.output_location.split('/')[:-1])
-            file_name = self.output_location.split('/')[-1]
+            file_path, file_name = self.split_path(self.output_location)
             if file_name != self.null_output:
-                addition_dir = self.parse_path(file_path)
-                if type(addition_dir) == dict:
-                    try:
-                        if self.output_mode == 'file':
-                            if addition_dir[file_name] != '%SPECIAL_NULL_FILE%':
-                                if addition_dir[file_name]:
-                                    addition_dir[file_name] += '\n'+self.output
-                                else:
-                                    addition_dir[file_name] = self.output
-                        elif self.output_mode == 'file_overwrite':
-                            if addition_dir[file_name] != '%SPECIAL_NULL_FILE%':
-                                addition_dir[file_name] = self.output
-                    except KeyError:
-                        addition_dir[file_name] = self.output
-                else:
-                    print('Error - destination is not a directory')
-                    stop = self.error_break('INVALID_PATH_ERROR')
+                with self.directory_lock(file_path):
+                    addition_dir = self.parse_path(file_path)
+                    if filesystem.is_dir(addition_dir):
+                        if filesystem.is_dir(addition_dir.get(file_name)):
+                            self.node_removed(self.output_location, addition_dir[file_name])
+                        try:
+                            if self.output_mode == 'file':
+                                if not filesystem.is_device(addition_dir[file_name], 'null'):
+                                    if addition_dir[file_name]:
+                                        # Appends go on the end of a chunked File instead of copying the whole content
+                                        if type(addition_dir[file_name]) == str:
+                                            addition_dir[file_name] = filesystem.File(addition_dir[file_name])
+                                        addition_dir[file_name].append('\n'+str(self.output))
+                                    else:
+                                        addition_dir[file_name] = filesystem.new_file(self.output, self.curr_user)
+                                    self.node_changed(self.output_location)
+                            elif self.output_mode == 'file_overwrite':
+                                if not filesystem.is_device(addition_dir[file_name], 'null'):
+                                    addition_dir[file_name] = filesystem.new_file(self.output, self.curr_user)
+                                    self.node_changed(self.output_location)
+                        except KeyError:
+                            addition_dir[file_name] = filesystem.new_file(self.output, self.curr_user)
+                            self.node_added(self.output_location)
+                    else:
+                        self.write_error('Error - destination is not a directory')
+                        self.output = None
+                        return 'INVALID_PATH_ERROR'
             self.output = None
 
     def postcmd(self, stop, line: str) -> bool:
         if stop is None:
             stop = ''
+        context = self.context
+        if context.output and not stop.endswith('ERROR'):
+            # Writing the output to a file can still fail
+            stop = self.flush() or stop
+            context.output = None
+        if context.capture is not None:
+            context.capture.record(stop if stop.endswith('ERROR') else 0)
         if stop.endswith('ERROR'):
             self.error_break(stop)
-        if self.output:
+        if context.output:
             self.flush()
-            self.output_mode = 'echo'
-            self.output = None
+            context.output = None
+        context.output_mode = 'echo'
+        if self.checkpoint_interval and time.time() - self.last_checkpoint > self.checkpoint_interval:
+            self.save()
         if stop == 'EXIT':
             self.error_break()
             return True
         else:
             return False
 
-    def find_file(self, name, folder):
-        results = []
-        name = re.compile(name.replace('.', '\.').replace('*', '.+').replace('?', '.'))
-        for file in folder:
-            if re.fullmatch(name, file):
-                results.append(file)
-        return results
+    def find_file(self, name, folder, folder_path=None):
+        pattern = filesystem.compile_glob(name)
+        if pattern.literal:
+            return [name] if name in folder else []
+        candidates = folder
+        if pattern.prefix and folder_path is not None:
+            candidates = self.name_index(folder_path, folder).with_prefix(pattern.prefix)
+        return [file for file in candidates if pattern.match(file)]
+
+    def name_index(self, folder_path, folder):
+        index = self.name_indexes.get(folder_path)
+        # Names added without going through node_added (e.g. by modules) show up as a length mismatch
+        if index is None or len(index.names) != len(folder):
+            index = self.name_indexes[folder_path] = filesystem.NameIndex(folder)
+        return index
 
     def do_echo(self, args):
         """Echo input to output: echo INPUT"""
-        self.output = args
+        if self.pipe_input is not None:
+            self.emit(itertools.chain([args] if args else [], self.pipe_input))
+        else:
+            self.output = args
 
     def do_raw(self, args):
         """Echo raw input to output: raw INPUT"""
@@ -371,118 +745,187 @@ class Computer(cmd.Cmd):
         args = [x.strip() for x in args.split('=')]
         name = re.match(r'(\w+)', args[0]).group(1)
         value = args[1]
-        self.variables['$'+name] = self.eval_expr(value)
+        try:
+            self.variables['$'+name] = self.evaluate(value)
+        except expressions.VariableNotFoundError as e:
+            self.write_error(f'Error - Variable {e.variable} not found.')
+            return 'VARIABLE_NOT_FOUND_ERROR'
+        except expressions.EvaluationError as e:
+            self.write_error(f'Error - {e}')
+            return 'EVALUATION_ERROR'
 
     def do_if(self, line, return_result=False):
         """Conditional execution: if [ COND ] ? TRUE_STATEMENT : FALSE_STATEMENT"""
-        conditional_expression = re.compile(r'\[\s+(.+)\s+\]')
-        is_directory_expression = re.compile(r'-d\s+(.+)')
-        is_file_expression = re.compile(r'-e\s+(.+)')
-        is_notempty_expression = re.compile(r'-s\s+(.+)')
-        expr = re.search(conditional_expression, line)
+        expr = re.search(scripting.conditional_expression, line)
         if not expr:
-            print('Error - if statement does not contain condition.')
+            self.write_error('Error - if statement does not contain condition.')
             return 'NO_CONDITION_ERROR'
         else:
-            condstring = expr.group(1).replace('-gt', '>').replace('-lt', '<').replace('-n', '0 <').replace('-z','0 ==').replace('! ', 'not ').replace('&&', 'and').replace('||', 'or')
-            is_dir = re.search(is_directory_expression, condstring)
-            if is_dir:
-                condstring = condstring.replace(is_dir.group(0), f'(type(self.parse_path("{is_dir.group(1)}")) == dict)')
-            is_file = re.search(is_file_expression, condstring)
-            if is_file:
-                condstring = condstring.replace(is_file.group(0), f'(type(self.parse_path("{is_file.group(1)}")) == str)')
-            is_notempty = re.search(is_notempty_expression, condstring)
-            if is_notempty:
-                condstring = condstring.replace(is_notempty.group(0),
-                                                f'(len(self.parse_path("{is_notempty.group(1)}")) > 0) and (type(self.parse_path("{is_notempty.group(1)}")) == str)')
-            result = self.evaluate_expressions(condstring, force_evaluate=True)
+            try:
+                result = self.test_condition(expr.group(1))
+            except expressions.VariableNotFoundError as e:
+                self.write_error(f'Error - Variable {e.variable} not found.')
+                return self.error_break('VARIABLE_NOT_FOUND_ERROR')
+            except conditions.ConditionError as e:
+                self.write_error(f'Error - {e}')
+                return 'INVALID_CONDITION_ERROR'
             targets = [_.strip() for _ in line.split('?')[1].split(':')]
             # Just return the result if instructed, otherwise execute then and else
             if return_result:
                 return result
             else:
                 if result:
-                    self.cmdqueue.insert(0, targets[0])
+                    self.cmdqueue.appendleft(targets[0])
                 elif (not result) and (len(targets)>1):
-                    self.cmdqueue.insert(0, targets[1])
+                    self.cmdqueue.appendleft(targets[1])
+
+    def test_condition(self, condition):
+        # Condition of an if or while, without the [ ]. Raises expressions.VariableNotFoundError and conditions.ConditionError
+        return conditions.compile_condition(condition)(self)
 
     def do_run(self, args):
         """Run shell script: run FILE_PATH"""
-        file_path = '/'.join(args.split('/')[:-1])
-        file_name = args.split('/')[-1]
-        attempt = self.parse_path(file_path)
-
-        if type(attempt) == dict:
-            try:
-                target_file = attempt[file_name]
-            except KeyError:
-                print(f'Error - file {file_name} not found.')
-                return 'FILE_NOT_FOUND_ERROR'
-        if target_file == '%SPECIAL_RANDOM_FILE%':
+        file_path, file_name = self.split_path(args)
+        attempt = self.parse_path(file_path, return_path=True)
+        if type(attempt) != tuple:
+            return attempt
+        attempt = attempt[0]
+        if not filesystem.is_dir(attempt):
+            self.write_error(f'Error - {file_path} is not a directory.')
+            return 'INVALID_PATH_ERROR'
+        try:
+            target_file = attempt[file_name]
+        except KeyError:
+            self.write_error(f'Error - file {file_name} not found.')
+            return 'FILE_NOT_FOUND_ERROR'
+        if type(target_file) == str:
+            target_file = filesystem.import_node(target_file)  # Marker strings put in place by modules
+        if filesystem.is_device(target_file, 'random'):
             self.output = random.random()
             return
-        elif target_file == '%SPECIAL_NULL_FILE%':
+        elif filesystem.is_device(target_file, 'null'):
             return
-        elif target_file == '%SPECIAL_PROCESS_FILE%':
+        elif filesystem.is_device(target_file, 'process'):
             self.curr_processes.append(file_name)
             getattr(self, f'do_{file_name}')('', origin='internal')
             return
-        body = target_file.split('\n')
+        outer_input = self.script_input
+        if self.pipe_input is not None:
+            self.script_input = self.pipe_input
+        try:
+            return self.run_program(scripting.get_program(str(target_file)), args)
+        finally:
+            self.script_input = outer_input
+
+    def run_program(self, program, name='script'):
         pointer = 0
-        return_stack = []
-        delete_next = False
-        while True:
-            line = body[pointer]
-            specials = ['if', 'goto', 'return', '#', 'pullfromqueue', ':']
-            if not (True in [True for _ in specials if line.startswith(_)]):
-                if '|' in line:
-                    if line.startswith('raw') and not re.search(r'".*|.*".*(|)', line).group(1):  # If there is a raw input line and there are no pipes after the quotes
-                        pass
-                    else:
-                        body.insert(pointer+1, 'pullfromqueue')
-                        delete_next = True
-                self.postcmd(self.onecmd(line), line)
-            elif line.startswith('if'):
-                result = self.do_if(line[2:].strip(), return_result=True)
-                targets = [_.strip() for _ in line.split('?')[1].split(':')]
-                if result:
-                    body.insert(pointer+1, targets[0])
-                    delete_next = True
-                elif (not result) and len(targets)>1:
-                    body.insert(pointer+1, targets[1])
-                    delete_next = True
-            elif line.startswith('goto'):
-                return_stack.append(pointer)
-                pointer = body.index(':'+line.split()[1].strip())
-            elif line.startswith('return'):
-                pointer = return_stack.pop(-1)
-            elif line.startswith('pullfromqueue'):
-                body.insert(pointer+1, self.cmdqueue.pop(0))
-                delete_next = True
-            if delete_next:
-                body.pop(pointer)
-                delete_next = False
+        # goto is also used as a plain jump for loops, so the stack is bounded by dropping its oldest frames
+        call_stack = collections.deque(maxlen=scripting.max_call_depth)
+        loops = {}  # Header index of each running for loop -> iterator over its remaining values
+        end = len(program.instructions)
+        try:
+            while 0 <= pointer < end:
+                profiler = self.profiler
+                if profiler is None:
+                    pointer = self.execute_instruction(program.instructions[pointer], pointer, call_stack, loops)
+                    continue
+                # Script lines are timed as NAME:LINE_NUMBER
+                profiler.enter(f'{name}:{program.lines[pointer]}')
+                try:
+                    pointer = self.execute_instruction(program.instructions[pointer], pointer, call_stack, loops)
+                finally:
+                    profiler.exit()
+        except scripting.ScriptError as e:
+            self.write_error(f'Error - {e}')
+            return e.error_code
+
+    def execute_instruction(self, instruction, pointer, call_stack, loops):
+        # Returns the index of the next instruction to run
+        opcode = instruction[0]
+        if opcode == scripting.OP_CMD:
+            self.postcmd(self.onecmd(instruction[1]), instruction[1])
+        elif opcode == scripting.OP_IF:
+            if instruction[1] is None:
+                raise scripting.ScriptError('if statement does not contain condition.', 'NO_CONDITION_ERROR')
+            if self.script_condition(instruction[1]):
+                return self.execute_instruction(instruction[2], pointer, call_stack, loops)
             else:
-                pointer += 1
-            if pointer > len(body)-1:
-                break
+                return self.execute_instruction(instruction[3], pointer, call_stack, loops)
+        elif opcode == scripting.OP_FOR:
+            if instruction[3] is None:
+                raise scripting.ScriptError('for loop without done.', 'LOOP_SYNTAX_ERROR')
+            try:
+                # Substituted values are split into words, only quotes written in the script keep words together
+                words = self.expand(shell_parser.parse_word(instruction[2]), quote=False)
+            except expressions.VariableNotFoundError as e:
+                raise scripting.ScriptError(f'Variable {e.variable} not found.', 'VARIABLE_NOT_FOUND_ERROR')
+            except expressions.EvaluationError as e:
+                raise scripting.ScriptError(str(e), 'EVALUATION_ERROR')
+            loops[pointer] = iter(scripting.loop_values(words))
+            return self.next_iteration(loops, pointer, instruction[1], instruction[3] + 1)
+        elif opcode == scripting.OP_WHILE:
+            if instruction[2] is None:
+                raise scripting.ScriptError('while loop without done.', 'LOOP_SYNTAX_ERROR')
+            return pointer + 1 if self.script_condition(instruction[1]) else instruction[2] + 1
+        elif opcode == scripting.OP_DONE:
+            if instruction[1] is None:
+                raise scripting.ScriptError('done outside of a loop.', 'LOOP_SYNTAX_ERROR')
+            if instruction[2] is None:
+                return instruction[1]  # Back to the while, which checks its condition again
+            return self.next_iteration(loops, instruction[1], instruction[2], pointer + 1)
+        elif opcode == scripting.OP_JUMP:
+            if instruction[2] is None:
+                raise scripting.ScriptError(f'{instruction[1]} outside of a loop.', 'LOOP_SYNTAX_ERROR')
+            return instruction[2]
+        elif opcode == scripting.OP_GOTO:
+            if instruction[2] is None:
+                raise scripting.ScriptError(f'Label {instruction[1]} not found.', 'LABEL_NOT_FOUND_ERROR')
+            call_stack.append(pointer)
+            return instruction[2]
+        elif opcode == scripting.OP_RETURN:
+            if not call_stack:
+                # Returning from the top level ends the script
+                return scripting.HALT
+            return call_stack.pop() + 1
+        return pointer + 1
+
+    def script_condition(self, condition):
+        # Errors in the condition of a script's if or while end the script
+        try:
+            return self.test_condition(condition)
+        except expressions.VariableNotFoundError as e:
+            raise scripting.ScriptError(f'Variable {e.variable} not found.', 'VARIABLE_NOT_FOUND_ERROR')
+        except conditions.ConditionError as e:
+            raise scripting.ScriptError(str(e), 'INVALID_CONDITION_ERROR')
+
+    def next_iteration(self, loops, header, variable, exit_pointer):
+        # Sets the for loop variable to the next value and returns where to carry on from
+        for value in loops[header]:
+            self.variables['$'+variable] = value
+            return header + 1
+        del loops[header]
+        return exit_pointer
 
     def do_cat(self, args):
         """Concatenate file contents: cat FILE_NAME1 FILE_NAME2 etc."""
+        if not args and self.pipe_input is not None:
+            return self.emit(self.pipe_input)
         files = args.split(' ')
         output = []
         for file in files:
-            file_path = '/'.join(file.split('/')[:-1])
-            file_name = file.split('/')[-1]
+            file_path, file_name = self.split_path(file)
             try:
-                attempt = self.parse_path(file_path)
-                if type(attempt) == dict:
-                    for located in self.find_file(file_name, attempt):
+                attempt = self.parse_path(file_path, return_path=True)
+                if type(attempt) != tuple:
+                    return attempt
+                attempt, path = attempt
+                if filesystem.is_dir(attempt):
+                    for located in self.find_file(file_name, attempt, path):
                         output.append(attempt[located])
             except KeyError:
-                print(f'Error - File {file_name} not found.')
+                self.write_error(f'Error - File {file_name} not found.')
                 return 'FILE_NOT_FOUND_ERROR'
-        self.output = '\n'.join(output)
+        self.emit(output)
 
     def do_cd(self, args):
         """Change current working directory: cd DIR_PATH"""
@@ -491,48 +934,68 @@ class Computer(cmd.Cmd):
             empty, self.cwd = attempt
 
     def do_ls(self, args):
-        """List items in directory: ls / ls DIR_PATH"""
+        """List items in directory: ls / ls DIR_PATH / ls -l DIR_PATH for type, owner, size and modification time"""
+        long_format = args == '-l' or args.startswith('-l ')
+        if long_format:
+            args = args[2:].strip()
         if args:
-            print(self.parse_path(args))
             target_dir = self.parse_path(args)
-            if type(target_dir) == dict:
-                self.output = ' '.join([item for item in target_dir if item[0] != '.'])
+            if not filesystem.is_dir(target_dir):
+                return
+            names = [item for item in target_dir if item[0] != '.']
         else:
-            print(self.parse_path(self.cwd))
-            self.output = ' '.join(self.parse_path(self.cwd))
+            target_dir = self.parse_path(self.cwd)
+            names = list(target_dir)
+        if not long_format:
+            self.output = ' '.join(names)
+            return
+        lines = []
+        for name in names:
+            node = target_dir[name]
+            kind = 'd' if filesystem.is_dir(node) else 'c' if filesystem.is_device(node) else '-'
+            mtime = filesystem.mtime(node)
+            modified = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)) if mtime is not None else '-'
+            lines.append(f'{kind} {filesystem.owner(node):<8} {filesystem.size(node):>8} {modified:>16} {name}')
+        self.output = '\n'.join(lines)
 
     def do_mkdir(self, args):
         """Make directory: mkdir DIR_NAME"""
         if args:
-            dir_path = '/'.join(args.split('/')[:-1])
-            dir_name = args.split('/')[-1]
+            dir_path, dir_name = self.split_path(args)
             try:
-                attempt = self.parse_path(dir_path)
-                if type(attempt) == dict:
-                    if self.check_invalid_name(dir_name):
-                        print('Error - Invalid character in directory name.')
-                        return 'INVALID_NAME_ERROR'
-                    else:
-                        try:
-                            a = attempt[dir_name]
-                            print(f'Error - Directory {dir_name} already exists.')
-                            return 'DIRECTORY_EXISTS_ERROR'
-                        except KeyError:
-                            attempt[dir_name] = {}
+                with self.directory_lock(dir_path):
+                    attempt = self.parse_path(dir_path)
+                    if filesystem.is_dir(attempt):
+                        if self.check_invalid_name(dir_name):
+                            self.write_error('Error - Invalid character in directory name.')
+                            return 'INVALID_NAME_ERROR'
+                        else:
+                            try:
+                                a = attempt[dir_name]
+                                self.write_error(f'Error - Directory {dir_name} already exists.')
+                                return 'DIRECTORY_EXISTS_ERROR'
+                            except KeyError:
+                                attempt[dir_name] = filesystem.Dir(owner=self.curr_user, mtime=time.time())
+                                self.node_added(args)
 
             except KeyError:
-                print(f'Error - File {args} not found.')
+                self.write_error(f'Error - File {args} not found.')
                 return 'FILE_NOT_FOUND_ERROR'
 
     def do_rmdir(self, args):
         """Remove directory: rmdir DIR_NAME"""
         if args:
-            print(self.parse_path(args))
-            if self.parse_path(args) == {}:
-                self.parse_path(args+'/..').pop(args.split('/')[-1])
-            else:
-                print('Error - target directory is not empty.')
-                return 'NOT_EMPTY_DIRECTORY_ERROR'
+            with self.directory_lock(self.split_path(args)[0]):
+                attempt = self.parse_path(args, return_path=True)
+                if type(attempt) != tuple:
+                    return attempt
+                target_dir, path = attempt
+                if target_dir == {}:
+                    self.node_removed(path, target_dir)
+                    self.parse_path(path+'/..').pop(path.split('/')[-1])
+                else:
+                    self.write_error('Error - target directory is not empty.')
+                    return 'NOT_EMPTY_DIRECTORY_ERROR'
 
     def do_pwd(self, args):
         """Print current working directory: pwd"""
@@ -540,45 +1003,49 @@ class Computer(cmd.Cmd):
 
     def do_touch(self, args):
         """Create new file: touch FILE_PATH"""
-        file_path = '/'.join(args.split('/')[:-1])
-        file_name = args.split('/')[-1]
+        file_path, file_name = self.split_path(args)
         if self.check_invalid_name(file_name):
-            print('Error - Invalid character in file name.')
+            self.write_error('Error - Invalid character in file name.')
             return 'FILENAME_ERROR'
         else:
-            attempt = self.parse_path(file_path)
-            if type(attempt) == dict:
-                try:
-                    a = attempt[file_name]
-                except KeyError:
-                    attempt[file_name] = ''
-                    print(attempt)
+            with self.directory_lock(file_path):
+                attempt = self.parse_path(file_path)
+                if filesystem.is_dir(attempt):
+                    try:
+                        a = attempt[file_name]
+                    except KeyError:
+                        attempt[file_name] = filesystem.File(owner=self.curr_user)
+                        self.node_added(args)
 
     def do_rm(self, args):
         """Delete file: rm FILE_PATH"""
-        file_path = '/'.join(args.split('/')[:-1])
-        file_name = args.split('/')[-1]
+        file_path, file_name = self.split_path(args)
         try:
-            attempt, path = self.parse_path(file_path, return_path=True)
-            if type(attempt) == dict:
-                for located in self.find_file(file_name, attempt):
-                    del attempt[located]
+            with self.directory_lock(file_path):
+                attempt = self.parse_path(file_path, return_path=True)
+                if type(attempt) != tuple:
+                    return attempt
+                attempt, path = attempt
+                if filesystem.is_dir(attempt):
+                    for located in self.find_file(file_name, attempt, path):
+                        self.node_removed(path + '/' + located, attempt[located])
+                        del attempt[located]
         except KeyError:
-            print(f'Error - File {args} not found.')
+            self.write_error(f'Error - File {args} not found.')
             return 'FILE_NOT_FOUND_ERROR'
 
     def do_user(self, args):
         """Manage users: user add/del/mod USERNAME OPTIONS"""
         if self.users[self.curr_user]['permissions'] != 'root':
-            print('Error - You don\'t have permission to perform this command')
+            self.write_error('Error - You don\'t have permission to perform this command')
             return 'PERMISSION_ERROR'
         else:
             args = args.split()
             if len(args) < 2:
-                print('Error - Insufficient arguments')
+                self.write_error('Error - Insufficient arguments')
                 return 'ARGUMENT_LENGTH_ERROR'
             if self.check_invalid_name(args[1]):
-                print('Error - Username invalid')
+                self.write_error('Error - Username invalid')
                 return 'INVALID_NAME_ERROR'
             if args[0] == 'add':
                 try:
@@ -592,7 +1059,7 @@ class Computer(cmd.Cmd):
                     del self.users[args[1]]
                     self.output = f'Deleted user {args[1]}.'
                 except KeyError:
-                    print(f'Error - User {args[1]} not found.')
+                    self.write_error(f'Error - User {args[1]} not found.')
                     return 'USER_NOT_FOUND_ERROR'
             elif args[0] == 'mod':
                 try:
@@ -603,10 +1070,10 @@ class Computer(cmd.Cmd):
                         target['permissions'] = 'user'
                     self.output = f'Modified permissions for user {args[1]}.'
                 except KeyError:
-                    print(f'Error - User {args[1]} not found.')
+                    self.write_error(f'Error - User {args[1]} not found.')
                     return 'USER_NOT_FOUND_ERROR'
                 except IndexError:
-                    print('Error - Please specify the operation you wish to perform.')
+                    self.write_error('Error - Please specify the operation you wish to perform.')
                     return 'ARGUMENT_LENGTH_ERROR'
 
     def do_sudo(self, args):
@@ -619,12 +1086,12 @@ class Computer(cmd.Cmd):
                 done = self.onecmd(args)
                 self.curr_user = old_user
             else:
-                print('Error - Incorrect password.')
+                self.write_error('Error - Incorrect password.')
                 done = 'INCORRECT_PASSWORD_ERROR'
         elif self.users[self.curr_user]['permissions'] == 'root':
             done = self.onecmd(args)
         else:
-            print('Error - You don\'t have permission to perform this command')
+            self.write_error('Error - You don\'t have permission to perform this command')
             done = 'PERMISSION_ERROR'
         return done
 
@@ -637,7 +1104,7 @@ class Computer(cmd.Cmd):
                 variable = args[0]
                 request = args[1]
             except IndexError:
-                print('Error - Please specify enough arguments.')
+                self.write_error('Error - Please specify enough arguments.')
                 return 'INVALID_ARGUMENT_ERROR'
             if len(args) > 2:
                 newval = ' '.join(args[2:])
@@ -659,10 +1126,10 @@ class Computer(cmd.Cmd):
                         setattr(self, variable, self.eval_expr(newval))
 
             else:
-                print('Error - Invalid or unmodifiable internal variable specified.')
+                self.write_error('Error - Invalid or unmodifiable internal variable specified.')
                 return 'INVALID_SYSTEM_VARIABLE_ERROR'
         else:
-            print('Error - You don\'t have permission to perform this command')
+            self.write_error('Error - You don\'t have permission to perform this command')
             return 'PERMISSION_ERROR'
 
     def do_pkgman(self, args):
@@ -682,11 +1149,12 @@ class Computer(cmd.Cmd):
                             self.onecmd('mkdir /tmp')
                             attempt = self.parse_path('/tmp')
                         attempt[arg+'_setup.sh'] = script
+                        self.node_added(f'/tmp/{arg}_setup.sh')
                         self.onecmd(f'sudo run /tmp/{arg}_setup.sh')
                     except KeyboardInterrupt:
-                        print(f'No startup script for module {arg} found or startup script failed')
+                        self.write_error(f'No startup script for module {arg} found or startup script failed')
                 except KeyboardInterrupt:
-                    print(f'Error - Module {arg} not found.')
+                    self.write_error(f'Error - Module {arg} not found.')
                     return 'MODULE_NOT_FOUND_ERROR'
             elif cmd == 'remove':
                 delattr(self, 'do_'+arg)
@@ -703,47 +1171,180 @@ class Computer(cmd.Cmd):
             if 'shell' not in self.curr_processes:
                 return 'EXIT'
         except ValueError:
-            print(f'Error - Invalid process id {args}')
+            self.write_error(f'Error - Invalid process id {args}')
             return 'INVALID_PID_ERROR'
         except IndexError:
-            print(f'Error - Invalid process id {args}')
+            self.write_error(f'Error - Invalid process id {args}')
             return 'INVALID_PID_ERROR'
 
     def do_grep(self, args):
+        """Search for lines matching pattern: grep [-r] LOCATION1 LOCATION2 etc. PATTERN / COMMAND | grep PATTERN"""
         args = args.split()
-        location = args[0]
-        searchstring = re.compile(args[1])
-        attempt = self.parse_path(location)
-        results = []
-        if type(attempt) == dict:
-            for item in attempt:
-                if type(item) == str:
-                    for line in item.split('\n'):
-                        if re.match(searchstring, line):
-                            results.append(line)
-        elif type(attempt) == str:
-            for line in attempt.split('\n'):
-                if re.match(searchstring, line):
-                    results.append(line)
-        self.output = '\n'.join(results)
+        recursive = '-r' in args
+        if recursive:
+            args.remove('-r')
+        piped = len(args) == 1 and self.pipe_input is not None
+        if len(args) < 2 and not piped:
+            self.write_error('Error - Please specify a location and a pattern.')
+            return 'ARGUMENT_LENGTH_ERROR'
+        try:
+            searchstring = search.compile_pattern(args[-1])
+        except re.error as e:
+            self.write_error(f'Error - Invalid pattern {args[-1]}: {e}')
+            return 'INVALID_ARGUMENT_ERROR'
+        if piped:
+            return self.emit(line for line in self.pipe_input if searchstring.match(line))
+        targets = []
+        for location in args[:-1]:
+            attempt = self.parse_path(location, return_path=True)
+            if type(attempt) != tuple:
+                return attempt
+            targets.append(attempt)
+        if len(targets) == 1 and filesystem.is_file(targets[0][0]):
+            # A single file gives just the matching lines
+            return self.emit(line for line in filesystem.iter_lines(targets[0][0]) if searchstring.match(line))
+        self.emit(self.grep_files(targets, searchstring, search.required_trigrams(args[-1]), recursive))
+
+    def do_locate(self, args):
+        """Find files with words in their path: locate WORD1 WORD2 etc."""
+        if not args.split():
+            self.write_error('Error - Please specify words to look for.')
+            return 'ARGUMENT_LENGTH_ERROR'
+        self.emit(self.refresh_search_index().lookup(args.split(), kinds=('name',)))
+
+    def do_search(self, args):
+        """Find files with words in their path or content: search WORD1 WORD2 etc."""
+        if not args.split():
+            self.write_error('Error - Please specify words to look for.')
+            return 'ARGUMENT_LENGTH_ERROR'
+        self.emit(self.refresh_search_index().lookup(args.split()))
+
+    def grep_files(self, targets, searchstring, trigrams, recursive):
+        # Matching lines as PATH:LINE_NUMBER:LINE, streamed as files and directories are searched
+        for node, path in targets:
+            if not filesystem.is_dir(node):
+                yield from self.grep_file(node, path, searchstring)
+                continue
+            candidates = None
+            if self.grep_indexing and trigrams:
+                with self.filesystem_lock:
+                    index = self.grep_indexes.get(path)
+                    if index is None:
+                        index = self.grep_indexes[path] = search.TrigramIndex()
+                    candidates = index.candidates(node, trigrams)
+            for name, child in list(node.items()):
+                child_path = persistence.child_path(path, name)
+                if filesystem.is_dir(child):
+                    if recursive:
+                        yield from self.grep_files([(self.parse_path(child_path), child_path)], searchstring, trigrams, recursive)
+                elif candidates is None or name in candidates:
+                    yield from self.grep_file(child, child_path, searchstring)
+
+    def grep_file(self, node, path, searchstring):
+        for number, line in enumerate(filesystem.iter_lines(node), 1):
+            if searchstring.match(line):
+                yield f'{path}:{number}:{line}'
 
     def do_lined(self, args):
         """Basic line editor: lined"""
-        argqueue = [_.strip() for _ in args.split('\n') if _ != '']
+        argqueue = collections.deque(_.strip() for _ in args.split('\n') if _ != '')
         arg_expression = re.compile(r'^(\d*,?\d*)(\S+)')
-        document = []
-        mode = 'wait'
-        scope = [0, 0]
-        prompt = ''
+        document = Document()
+        state = {'mode': 'wait', 'scope': [0, 0], 'prompt': ''}
+
+        def edit(cmd, instruction, scope):
+            # Run one command in wait mode on the lines in scope, returning the document text on quit
+            curr_key = instruction[0]
+            if curr_key == 'a':
+                state['mode'] = 'append'
+            elif curr_key == 'l' or curr_key == 'p':
+                if not document:
+                    return
+                output = []
+                for index, item in enumerate(scope):
+                    if item == -1:
+                        scope[index] = len(document)-1
+                i = scope[0]
+                while True:
+                    output.append(document[i].replace('$', '\\$')+'$' if curr_key == 'l' else document[i])
+                    i += 1
+                    if i > scope[1]:
+                        break
+                self.output = '\n'.join(output)
+                self.flush()
+            elif curr_key == 'w':
+                text = document.text()
+                try:
+                    dest = cmd.split()[1]
+                except IndexError:
+                    return
+                file_path, file_name = self.split_path(dest)
+                with self.directory_lock(file_path):
+                    attempt = self.parse_path(file_path)
+                    if not filesystem.is_dir(attempt):
+                        self.write_error('Error - destination is not a directory')
+                        return
+                    try:
+                        if not filesystem.is_device(attempt[file_name], 'null') and (filesystem.is_dir(attempt)) and filesystem.is_file(attempt[file_name]):
+                            attempt[file_name] = filesystem.new_file(text, self.curr_user)
+                            self.node_changed(dest)
+                    except KeyError:
+                        attempt[file_name] = filesystem.new_file(text, self.curr_user)
+                        self.node_added(dest)
+                self.output = len(text)
+                self.flush()
+            elif curr_key == 'i':
+                state['mode'] = 'insert'
+            elif curr_key == 'd' or curr_key == 'c':
+                document.delete(scope[0], scope[1])
+                state['scope'] = [scope[0], scope[0]]
+                if curr_key == 'c':
+                    state['mode'] = 'append'
+            elif curr_key == 's':
+                if not document:
+                    return
+                instruction = instruction.split('/')
+                pattern = re.compile(instruction[1])
+                for index, item in enumerate(scope):
+                    if item == -1:
+                        scope[index] = len(document)-1
+                i = scope[0]
+                while True:
+                    document[i] = pattern.sub(instruction[2], document[i])
+                    i += 1
+                    if i > scope[1]:
+                        break
+            elif curr_key == 'g':
+                # The pattern is matched against every line in one pass, then the commands run on each matching line
+                ops = cmd.split('/')
+                pattern = re.compile(ops[1])
+                subcmdlist = '/'.join(ops[2:]).split('\\')
+                for index in document.search(pattern):
+                    for subcmd in subcmdlist:
+                        subcmd = str(index) + subcmd
+                        state['scope'] = [index, index]
+                        result = edit(subcmd, re.match(arg_expression, subcmd).group(2), state['scope'])
+                        if result is not None:
+                            return result
+            elif curr_key == 'P':
+                state['prompt'] = '> '
+            elif curr_key == '!':
+                self.redirect_output = True
+                self.onecmd(cmd[1:])
+                document.append('\n'.join(self.output_buffer))
+                self.output_buffer.clear()
+                self.redirect_output = False
+            elif curr_key == 'q':
+                return document.text()
+
         while True:
             try:
-                if document:
-                    document = '\n'.join(document).split('\n')
                 if not argqueue:
-                    cmd = self.request_input(prompt)
+                    cmd = self.request_input(state['prompt'])
                 else:
-                    cmd = argqueue.pop(0)
-                if mode == 'wait':
+                    cmd = argqueue.popleft()
+                scope = state['scope']
+                if state['mode'] == 'wait':
                     argmatch = re.match(arg_expression, cmd)
                     curr_scope = argmatch.group(1)
                     instruction = argmatch.group(2)
@@ -752,159 +1353,169 @@ class Computer(cmd.Cmd):
                     try:
                         scope = [int(curr_scope), int(curr_scope)]
                     except ValueError:
-                        if scope == ',':
+                        if curr_scope == ',':
                             scope = [0, -1]
-                        elif scope:
+                        elif curr_scope:
                             scope = [int(curr_scope.split(',')[0]), int(curr_scope.split(',')[1])]
                         # Else, scope is preserved from last line
-                    # for index, item in enumerate(scope):
-                    #     if item < 0:
-                    #         scope[index] = 0
-                    #     if item > len(document)-1:
-                    #         scope[index] = len(document)
-                    curr_key = instruction[0]
-                    if curr_key == 'a':
-                        mode = 'append'
-                    elif curr_key == 'l':
-                        if not document:
-                            continue
-                        output = []
-                        for index, item in enumerate(scope):
-                            if item == -1:
-                                scope[index] = len(document)-1
-                        i = scope[0]
-                        while True:
-                            output.append(document[i].replace('$', '\$')+'$')
-                            i += 1
-                            if i > scope[1]:
-                                break
-                        self.output = '\n'.join(output)
-                        self.flush()
-                    elif curr_key == 'w':
-                        try:
-                            dest = cmd.split()[1]
-                            file_path = '/'.join(dest.split('/')[:-1])
-                            file_name = dest.split('/')[-1]
-                            attempt = self.parse_path(file_path)
-                            if (attempt[file_name] != '%SPECIAL_NULL_FILE%') and (type(attempt) == dict) and (type(attempt[file_name]) == str):
-                               attempt[file_name] = '\n'.join(document)
-                        except IndexError:
-                            continue
-                        except KeyError:
-                            attempt[file_name] = '\n'.join(document)
-                        self.output = (len('\n'.join(document)))
-                        self.flush()
-                    elif curr_key == 'i':
-                        mode = 'insert'
-                    elif curr_key == 'd':
-                        document = document[:scope[0]]+document[scope[1]:]
-                        scope = [scope[0], scope[0]]
-                    elif curr_key == 'c':
-                        document = document[:scope[0]] + document[scope[1]:]
-                        scope = [scope[0], scope[0]]
-                        mode = 'append'
-                    elif curr_key == 's':
-                        if not document:
-                            continue
-                        instruction = instruction.split('/')
-                        for index, item in enumerate(scope):
-                            if item == -1:
-                                scope[index] = len(document)-1
-                        i = scope[0]
-                        while True:
-                            document[i] = re.sub(re.compile(instruction[1]), instruction[2], document[i])
-                            i += 1
-                            if i > scope[1]:
-                                break
-                    elif curr_key == 'p':
-                        if not document:
-                            continue
-                        output = []
-                        for index, item in enumerate(scope):
-                            if item == -1:
-                                scope[index] = len(document)-1
-                        i = scope[0]
-                        while True:
-                            output.append(document[i])
-                            i += 1
-                            if i > scope[1]:
-                                break
-                        self.output = '\n'.join(output)
-                        self.flush()
-                    elif curr_key == 'g':
-                        ops = cmd.split('/')
-                        pattern = ops[1]
-                        subcmdlist = '/'.join(ops[2:]).split('\\')
-                        foundlines = []
-                        for index, line in enumerate(document):
-                            if re.match(re.compile(pattern), line):
-                                foundlines.append(index)
-                        for index in foundlines:
-                            print([str(index)+x for x in subcmdlist])
-                            argqueue += [str(index)+x for x in subcmdlist]
-                    elif curr_key == 'P':
-                        prompt = '> '
-                    elif curr_key == '!':
-                        self.redirect_output = True
-                        self.onecmd(cmd[1:])
-                        document.append('\n'.join(self.output_buffer))
-                        self.output_buffer = []
-                        self.redirect_output = False
-                    elif curr_key == 'q':
-                        return '\n'.join(document)
-                elif mode == 'append':
+                    state['scope'] = scope
+                    result = edit(cmd, instruction, scope)
+                    if result is not None:
+                        return result
+                elif state['mode'] == 'append':
                     if cmd != '.':
                         document.insert(scope[0]+1, cmd)
-                        scope = [scope[0]+1, scope[0]+1]
+                        state['scope'] = [scope[0]+1, scope[0]+1]
                     else:
-                        mode = 'wait'
-                elif mode == 'insert':
+                        state['mode'] = 'wait'
+                elif state['mode'] == 'insert':
                     if cmd != '.':
                         if document:
                             if scope[0] > 0:
                                 document.insert(scope[0]-1, cmd)
                             else:
-                                document = [cmd]+document
-                            scope = [scope[0] + 1, scope[0] + 1]
+                                document.insert(0, cmd)
+                            state['scope'] = [scope[0] + 1, scope[0] + 1]
                         else:
-                            document = [cmd]
+                            document.insert(0, cmd)
                     else:
-                        mode = 'wait'
+                        state['mode'] = 'wait'
             except KeyboardInterrupt:
                 continue
 
+    def do_stats(self, args):
+        """Show time spent per command, script line and expression: stats on / stats off / stats reset / stats folded / stats [COUNT]"""
+        if args == 'on':
+            if self.profiler is None:
+                self.profiler = profiling.Profiler()
+        elif args == 'off':
+            self.profiler = None
+        elif self.profiler is None:
+            self.write_error('Error - Profiling is off, turn it on with stats on.')
+            return 'PROFILING_OFF_ERROR'
+        elif args == 'reset':
+            self.profiler.reset()
+        elif args == 'folded':
+            # Time per call stack in microseconds, for flamegraph tools
+            self.output = '\n'.join(self.profiler.folded_stacks())
+        else:
+            try:
+                limit = int(args) if args else 20
+            except ValueError:
+                self.write_error('Error - Invalid number of rows.')
+                return 'INVALID_ARGUMENT_ERROR'
+            self.output = self.profiler.format_report(limit)
+
     def do_shutdown(self, args):
         """Shutdown computer: shutdown"""
         self.save()
         return 'EXIT'
 
-    def parse_path(self, path, return_path=False):
-        curr_dir = self.filesystem
-        if len(path) > 0:
-            if not path[0] == '/':
-                path = self.cwd+path
-        else:
-            path = self.cwd
-        tempcwd = '/'
-        path = path.split('/')
-        for item in path:
+    def split_path(self, path):
+        # Directory and name of path, e.g. '/a/b' -> ('/a', 'b'), '/b' -> ('/', 'b') and 'b' -> ('', 'b') for the cwd
+        dir_path, separator, name = path.rpartition('/')
+        if separator and not dir_path:
+            dir_path = '/'
+        return dir_path, name
+
+    def normalize_path(self, path):
+        # Absolute form of path with . and .. resolved, e.g. 'bin/../users' from / is '/users'
+        if not path.startswith('/'):
+            path = self.cwd.rstrip('/') + '/' + path
+        parts = []
+        for item in path.split('/'):
             if item == '.' or item == '':
                 continue
             elif item == '..':
-                tempcwd = '/'+'/'.join(tempcwd.split('/')[:-1])
-                curr_dir = self.parse_path(tempcwd)
+                if parts:
+                    parts.pop()
             else:
-                try:
-                    curr_dir = curr_dir[item]
-                    tempcwd += item
-                except KeyError:
-                    print(f'Error - directory {item} does not exist.')
-                    return 'INVALID_PATH_ERROR'
+                parts.append(item)
+        return '/' + '/'.join(parts)
+
+    def parse_path(self, path, return_path=False):
+        path = self.normalize_path(path)
+        try:
+            curr_dir = self.path_cache[path]
+        except KeyError:
+            # Files are found through their (cached) parent directory, anything else is walked from the root
+            parent, _, name = path.rpartition('/')
+            parent_dir = self.path_cache.get(parent or '/')
+            if filesystem.is_dir(parent_dir) and name in parent_dir and not filesystem.is_dir(parent_dir[name]):
+                return (parent_dir[name], path) if return_path else parent_dir[name]
+            curr_dir = self.filesystem
+            walked = ''
+            with self.filesystem_lock:
+                for item in path.split('/')[1:]:
+                    try:
+                        parent_dir, curr_dir = curr_dir, curr_dir[item]
+                    except (KeyError, TypeError):
+                        self.write_error(f'Error - directory {item} does not exist.')
+                        return 'INVALID_PATH_ERROR'
+                    walked += '/' + item
+                    # Only directories are cached, they are the only nodes that are changed in place.
+                    # Every cached directory has had its saved contents loaded and is private to this machine.
+                    if filesystem.is_dir(curr_dir):
+                        if id(curr_dir) in filesystem.frozen_directories:
+                            curr_dir = parent_dir[item] = filesystem.thaw(curr_dir)
+                        self.store.hydrate(curr_dir)
+                        self.path_cache[walked] = curr_dir
         if return_path:
-            return curr_dir, tempcwd
+            return curr_dir, path
         else:
             return curr_dir
 
+    def lookup_node(self, path):
+        # Like parse_path for absolute, normalized paths, but silent and returning None for missing nodes
+        node = self.filesystem
+        with self.filesystem_lock:
+            for item in path.split('/')[1:] if path != '/' else []:
+                self.store.hydrate(node)
+                if not filesystem.is_dir(node) or item not in node:
+                    return None
+                node = node[item]
+        return node
+
+    def node_added(self, path):
+        path = self.normalize_path(path)
+        self.command_cache.generation += 1
+        self.store.mark_dirty(path)
+        parent, _, name = path.rpartition('/')
+        index = self.name_indexes.get(parent or '/')
+        if index is not None:
+            index.add(name)
+        self.mark_grep_stale(path)
+        self.search_index.mark(path)
+
+    def node_changed(self, path):
+        path = self.normalize_path(path)
+        self.command_cache.generation += 1
+        self.store.mark_dirty(path)
+        self.mark_grep_stale(path)
+        self.search_index.mark(path)
+
+    def mark_grep_stale(self, path):
+        parent, _, name = path.rpartition('/')
+        index = self.grep_indexes.get(parent or '/')
+        if index is not None:
+            index.stale.add(name)
+
+    def node_removed(self, path, node=None):
+        # Called whenever the node at path is deleted or replaced, so nothing under it stays cached
+        path = self.normalize_path(path)
+        self.command_cache.generation += 1
+        self.store.mark_dirty(path)
+        self.name_indexes.pop(path.rpartition('/')[0] or '/', None)
+        self.mark_grep_stale(path)
+        self.search_index.mark(path)
+        if filesystem.is_dir(node):
+            self.store.discard(node)
+            for cached in [_ for _ in self.path_cache if _ == path or _.startswith(path + '/')]:
+                del self.path_cache[cached]
+            for indexed in [_ for _ in self.name_indexes if _ == path or _.startswith(path + '/')]:
+                del self.name_indexes[indexed]
+            for indexed in [_ for _ in self.grep_indexes if _ == path or _.startswith(path + '/')]:
+                del self.grep_indexes[indexed]
 
 def main():
     import local_web_network
@@ -957,13 +1568,15 @@ def main():
     ivan = local_web_network.make_basic_computer('ivan', 'scidept1981', {
         '3a_grades.txt': 'Tanya Novikova 31\nEkaterina Mikhailovna 57\nSavva Bogdanov 62\nMikhail Simonov 20\nZoya Pavlova 40\nKonstantin Frolov 42\nLev Kuznetsov 45\nOnisim Volkov 47\nStegnov Denisovich 42\nYeltsov Sergeyevich 50',
         '3b_grades.txt': 'Aptekar Artur Pavlovich 40\nKalganov Tikhonovich 31\nLuski Valerianovich 52\nDaniltsin Konstantinovich 44\nRozhkov Yermolayevich 67\nYugantsev Yaroslavovich 40\nLipin Yegorovich 41\nTurbin Vyacheslavovich 48'})
-    try:
-        with open('main_save.save') as f:
-            test = pickle.load(f)
-    except FileNotFoundError:
+    if os.path.exists('main_save.save'):
+        test = Computer.load('main_save.save')
+    else:
         test = Computer()
-    local_web_network.Router(test, peter, ivan, universityserver)
-    test.startup()
+    router = local_web_network.Router(test, peter, ivan, universityserver)
+    try:
+        test.startup()
+    finally:
+        router.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,141 @@
+import json
+import sqlite3
+import threading
+
+import filesystem
+
+
+def child_path(path, name):
+    return path.rstrip('/') + '/' + name
+
+
+class Store:
+    """SQLite save file for a computer, holding one row per filesystem node plus users and variables.
+
+    Only nodes marked dirty are rewritten on a checkpoint, and saved directories are loaded one
+    level at a time as they are visited (see hydrate)."""
+    def __init__(self, location):
+        self.location = location
+        self.connection = None
+        # Paths whose subtree has to be rewritten (or deleted) on the next checkpoint
+        self.dirty = set()
+        # id(directory) -> (directory, path) for saved directories whose contents haven't been loaded yet
+        self.pending = {}
+        # Sessions in several threads share the connection, so every use of it and of dirty holds this
+        self.lock = threading.RLock()
+
+    def connect(self):
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.location, check_same_thread=False)
+                self.connection.executescript('''
+                    CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, parent TEXT, name TEXT, kind TEXT, content TEXT,
+                                                      owner TEXT, mtime REAL);
+                    CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent);
+                    CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY, password TEXT, permissions TEXT);
+                    CREATE TABLE IF NOT EXISTS variables (name TEXT PRIMARY KEY, value TEXT);
+                    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                    CREATE TABLE IF NOT EXISTS search_tokens (path TEXT, kind TEXT, token TEXT);
+                    CREATE INDEX IF NOT EXISTS search_tokens_path ON search_tokens (path);
+                ''')
+                # Save files from before nodes had owners and modification times
+                columns = {row[1] for row in self.connection.execute('PRAGMA table_info(nodes)')}
+                for column, kind in (('owner', 'TEXT'), ('mtime', 'REAL')):
+                    if column not in columns:
+                        self.connection.execute(f'ALTER TABLE nodes ADD COLUMN {column} {kind}')
+            return self.connection
+
+    def mark_dirty(self, path):
+        with self.lock:
+            self.dirty.add(path)
+
+    def lazy_directory(self, path, owner='root', mtime=None):
+        directory = filesystem.Dir(owner=owner, mtime=mtime)
+        self.pending[id(directory)] = (directory, path)
+        return directory
+
+    def hydrate(self, directory):
+        with self.lock:
+            try:
+                directory, path = self.pending.pop(id(directory))
+            except KeyError:
+                return
+            rows = self.connect().execute('SELECT name, kind, content, owner, mtime FROM nodes WHERE parent = ?', (path,))
+            for name, kind, content, owner, mtime in rows:
+                if kind == 'dir':
+                    directory[name] = self.lazy_directory(child_path(path, name), owner or 'root', mtime)
+                else:
+                    directory[name] = filesystem.import_node(content, owner or 'root', mtime)
+
+    def discard(self, node):
+        self.pending.pop(id(node), None)
+
+    def collect_rows(self, path, node):
+        rows = []
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            parent, _, name = path.rpartition('/')
+            parent = (parent or '/') if path != '/' else None
+            if filesystem.is_dir(node):
+                self.hydrate(node)
+                rows.append((path, parent, name, 'dir', None, filesystem.owner(node), filesystem.mtime(node)))
+                stack.extend((child_path(path, child_name), child) for child_name, child in list(node.items()))
+            else:
+                rows.append((path, parent, name, 'file', str(node), filesystem.owner(node), filesystem.mtime(node)))
+        return rows
+
+    def checkpoint(self, lookup, users, variables, meta, search_rows=()):
+        """Write dirty nodes, users, variables and meta to disk. lookup(path) returns the node at path or None.
+        search_rows holds (path, [(path, kind, token), ...]) for every file whose search index rows changed"""
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            try:
+                self.write(dirty, lookup, users, variables, meta, search_rows)
+            except Exception:
+                self.dirty.update(dirty)  # Written again on the next checkpoint
+                raise
+
+    def write(self, dirty, lookup, users, variables, meta, search_rows):
+        connection = self.connect()
+        # Parents first, so a rewritten directory doesn't delete rows written for its children
+        changes = []
+        for path in sorted(dirty, key=lambda _: _.count('/') if _ != '/' else 0):
+            node = lookup(path)
+            changes.append((path, self.collect_rows(path, node) if node is not None else []))
+        with connection:
+            for path, rows in changes:
+                if path == '/':
+                    connection.execute('DELETE FROM nodes')
+                    connection.execute('DELETE FROM search_tokens')
+                else:
+                    connection.execute('DELETE FROM nodes WHERE path = ? OR substr(path, 1, ?) = ?',
+                                       (path, len(path)+1, path + '/'))
+                connection.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            for path, rows in search_rows:
+                connection.execute('DELETE FROM search_tokens WHERE path = ?', (path,))
+                connection.executemany('INSERT INTO search_tokens VALUES (?, ?, ?)', rows)
+            connection.execute('DELETE FROM users')
+            connection.executemany('INSERT INTO users VALUES (?, ?, ?)',
+                                   [(name, user['password'], user['permissions']) for name, user in users.items()])
+            connection.execute('DELETE FROM variables')
+            connection.executemany('INSERT INTO variables VALUES (?, ?)',
+                                   [(name, json.dumps(value, default=str)) for name, value in variables.items()])
+            connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                   [(key, json.dumps(value)) for key, value in meta.items()])
+
+    def load_users(self):
+        rows = self.connect().execute('SELECT name, password, permissions FROM users').fetchall()
+        return {name: {'password': password, 'permissions': permissions} for name, password, permissions in rows}
+
+    def load_variables(self):
+        rows = self.connect().execute('SELECT name, value FROM variables').fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    def load_search_rows(self):
+        return self.connect().execute('SELECT path, kind, token FROM search_tokens').fetchall()
+
+    def load_meta(self):
+        rows = self.connect().execute('SELECT key, value FROM meta').fetchall()
+        return {key: json.loads(value) for key, value in rows}
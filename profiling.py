@@ -0,0 +1,75 @@
+import collections
+import time
+
+
+class Record:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0  # Seconds, including nested commands, script lines and expressions
+        self.own = 0.0  # Seconds spent outside of nested frames
+        self.output_bytes = 0
+
+
+class Profiler:
+    """Opt-in timing of commands, script lines and expressions for a Computer (see do_stats).
+
+    Every timed call is a frame on a stack, so time is also collected per whole stack,
+    in the folded format used by flamegraph tools ('run;/tmp/a.sh:3;echo 1500', in microseconds)."""
+    def __init__(self):
+        self.records = collections.defaultdict(Record)
+        self.folded = collections.Counter()
+        self.stack = []  # [label, start time, seconds spent in nested frames]
+        self.last_command = None
+
+    def enter(self, label):
+        self.stack.append([label, time.perf_counter(), 0.0])
+
+    def exit(self):
+        label, start, nested = self.stack[-1]
+        elapsed = time.perf_counter() - start
+        record = self.records[label]
+        record.calls += 1
+        record.total += elapsed
+        record.own += elapsed - nested
+        self.folded[';'.join(frame[0].replace(';', ',') for frame in self.stack)] += elapsed - nested
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def add_output(self, size, label=None):
+        label = label or self.last_command
+        if label is not None:
+            self.records[label].output_bytes += size
+
+    def count_stream(self, lines):
+        # Output handed on down a pipeline is only counted as it is read, by which time last_command is the
+        # reading stage, so the label is taken now
+        return self.counted_lines(lines, self.last_command)
+
+    def counted_lines(self, lines, label):
+        for line in lines:
+            self.add_output(len(str(line).encode()) + 1, label)
+            yield line
+
+    def reset(self):
+        self.records.clear()
+        self.folded.clear()
+
+    def report(self, limit=None):
+        """Rows of (label, calls, total seconds, own seconds, output bytes), most total time first"""
+        rows = [(label, record.calls, record.total, record.own, record.output_bytes) for label, record in self.records.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit] if limit else rows
+
+    def format_report(self, limit=None):
+        lines = [f'{"CALLS":>8} {"TOTAL ms":>10} {"OWN ms":>10} {"MEAN us":>10} {"BYTES":>10}  NAME']
+        for label, calls, total, own, output_bytes in self.report(limit):
+            lines.append(f'{calls:>8} {total*1e3:>10.2f} {own*1e3:>10.2f} {total/calls*1e6:>10.1f} {output_bytes:>10}  {label}')
+        return '\n'.join(lines)
+
+    def folded_stacks(self):
+        return [f'{stack} {round(seconds * 1e6)}' for stack, seconds in self.folded.items() if round(seconds * 1e6)]
+
+    def dump_folded(self, location):
+        with open(location, 'w') as f:
+            f.write('\n'.join(self.folded_stacks()) + '\n')
@@ -0,0 +1,151 @@
+import hashlib
+import re
+import shlex
+from collections import OrderedDict
+
+import shell_parser
+
+# Instruction opcodes for compiled shell scripts
+OP_NOP = 0  # Comments, labels and blank lines
+OP_CMD = 1  # (OP_CMD, line) - run line, with its pipelines and redirects, through onecmd/postcmd
+OP_IF = 2  # (OP_IF, condition, then_instruction, else_instruction) - condition is the text in [ ], None if missing
+OP_GOTO = 3  # (OP_GOTO, label, target_index) - target_index is None for unknown labels
+OP_RETURN = 4  # (OP_RETURN,)
+OP_FOR = 5  # (OP_FOR, variable, words, done_index) - start a loop over the expanded words
+OP_WHILE = 6  # (OP_WHILE, condition, done_index) - run the loop body while condition holds
+OP_DONE = 7  # (OP_DONE, header_index, variable) - next iteration of a loop, variable is None for while loops
+OP_JUMP = 8  # (OP_JUMP, keyword, target_index) - break and continue, target_index is None outside of loops
+
+HALT = -1  # Instruction pointer value that stops the interpreter
+
+max_call_depth = 1024
+
+script_cache = OrderedDict()
+script_cache_size = 256
+
+loop_keyword_expression = re.compile(r'(for|while|do|done)\b')
+for_expression = re.compile(r'for\s+(\w+)(?:\s+in\b(.*))?$')
+integer_expression = re.compile(r'-?\d+')
+conditional_expression = re.compile(r'\[\s+(.+)\s+\]')
+
+
+class ScriptError(Exception):
+    def __init__(self, message, error_code):
+        super().__init__(message)
+        self.error_code = error_code
+
+
+class Program:
+    def __init__(self, instructions, labels, lines):
+        self.instructions = instructions
+        # Jump table, label name -> index of the instruction after the label line
+        self.labels = labels
+        # Source line number of each instruction, lines with loop keywords can compile to several
+        self.lines = lines
+
+
+def compile_line(line):
+    line = line.strip()
+    if not line or line.startswith('#') or line.startswith(':'):
+        return (OP_NOP,)
+    elif line.startswith('if'):
+        branches = line.split('?', 1)
+        targets = [_.strip() for _ in branches[1].split(':')] if len(branches) > 1 else ['']
+        then_instruction = compile_line(targets[0])
+        else_instruction = compile_line(targets[1]) if len(targets) > 1 else (OP_NOP,)
+        condition = conditional_expression.search(branches[0])
+        return (OP_IF, condition and condition.group(1), then_instruction, else_instruction)
+    elif line.startswith('goto'):
+        return (OP_GOTO, line.split()[1].strip())
+    elif line.startswith('return'):
+        return (OP_RETURN,)
+    elif line == 'break' or line == 'continue':
+        return (OP_JUMP, line)
+    else:
+        return (OP_CMD, line)
+
+
+def compile_script(source):
+    instructions = []
+    lines = []
+    labels = {}
+    open_loops = []  # Header indexes of the loops whose done hasn't been compiled yet
+    enclosing = []  # Header index of the innermost loop around each instruction, or None
+    done_indexes = {}  # Header index -> index of the loop's done
+    for number, line in enumerate(source.split('\n'), 1):
+        line = line.strip()
+        # Loop keywords can share a line with the loop body, as in: for x in a b; do echo $x; done
+        statements = shell_parser.split_statements(line) if loop_keyword_expression.match(line) else [line]
+        for statement in statements:
+            if statement == 'do' or statement.startswith('do '):
+                statement = statement[2:].strip()
+                if not statement:
+                    continue
+            index = len(instructions)
+            keyword = loop_keyword_expression.match(statement)
+            keyword = keyword and keyword.group(1)
+            header = None
+            for_loop = for_expression.match(statement) if keyword == 'for' else None
+            if for_loop:
+                header = instruction = (OP_FOR, for_loop.group(1), for_loop.group(2) or '', None)
+            elif keyword == 'while':
+                condition = statement[5:].strip()
+                bracketed = conditional_expression.fullmatch(condition)
+                header = instruction = (OP_WHILE, bracketed.group(1) if bracketed else condition, None)
+            elif keyword == 'done':
+                if open_loops:
+                    start = open_loops.pop()
+                    done_indexes[start] = index
+                    instructions[start] = instructions[start][:-1] + (index,)
+                    instruction = (OP_DONE, start, instructions[start][1] if instructions[start][0] == OP_FOR else None)
+                else:
+                    instruction = (OP_DONE, None, None)
+            else:
+                if statement.startswith(':'):
+                    labels[statement[1:].strip()] = index + 1
+                instruction = compile_line(statement)
+            instructions.append(instruction)
+            lines.append(number)
+            enclosing.append(open_loops[-1] if open_loops else None)
+            if header:
+                open_loops.append(index)
+    # Resolve every goto, break and continue once, so jumps at runtime are a single index assignment
+    instructions = [link(instruction, labels, done_indexes.get(loop)) for instruction, loop in zip(instructions, enclosing)]
+    return Program(instructions, labels, lines)
+
+
+def link(instruction, labels, loop_done=None):
+    if instruction[0] == OP_GOTO:
+        return (OP_GOTO, instruction[1], labels.get(instruction[1]))
+    elif instruction[0] == OP_JUMP:
+        if loop_done is None:
+            return (OP_JUMP, instruction[1], None)
+        # continue jumps to the done, which starts the next iteration
+        return (OP_JUMP, instruction[1], loop_done + 1 if instruction[1] == 'break' else loop_done)
+    elif instruction[0] == OP_IF:
+        return (OP_IF, instruction[1], link(instruction[2], labels, loop_done), link(instruction[3], labels, loop_done))
+    return instruction
+
+
+def loop_values(text):
+    # Words of an expanded for loop list, quoted words stay together and whole numbers become ints
+    try:
+        words = shlex.split(text)
+    except ValueError:
+        words = text.split()
+    return [int(word) if integer_expression.fullmatch(word) else word for word in words]
+
+
+
+def get_program(source):
+    """Return the compiled program for a script, compiling it only if its content hasn't been seen before"""
+    key = hashlib.sha1(source.encode()).hexdigest()
+    try:
+        script_cache.move_to_end(key)
+        return script_cache[key]
+    except KeyError:
+        program = compile_script(source)
+        script_cache[key] = program
+        if len(script_cache) > script_cache_size:
+            script_cache.popitem(last=False)
+        return program
@@ -0,0 +1,214 @@
+import collections
+import functools
+import re
+
+import filesystem
+import persistence
+
+token_expression = re.compile(r'\w+')
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    return re.compile(pattern)
+
+
+@functools.lru_cache(maxsize=256)
+def required_trigrams(pattern):
+    """Trigrams that every line matching pattern has to contain, empty if nothing is certain"""
+    trigrams = set()
+    for literal in required_literals(pattern):
+        trigrams.update(literal[index:index+3] for index in range(len(literal)-2))
+    return frozenset(trigrams)
+
+
+def required_literals(pattern):
+    # Runs of plain characters that any match has to contain. Patterns with alternatives or inline
+    # flags (which may make a run case insensitive) are given up on rather than analysed.
+    if '|' in pattern or '(?' in pattern:
+        return []
+    literals = []
+    current = []
+    groups = []
+
+    def end_run():
+        if current:
+            literals.append(''.join(current))
+            current.clear()
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            escaped = pattern[index+1:index+2]
+            if escaped and not escaped.isalnum():
+                current.append(escaped)
+            else:
+                end_run()  # Character classes like \d and backreferences
+            index += 2
+            continue
+        if char in '*?{':
+            # The last character may not be there at all
+            if current:
+                current.pop()
+            end_run()
+            if char == '{':
+                index = pattern.find('}', index)
+                if index == -1:
+                    return []
+        elif char == '[':
+            end_run()
+            index = pattern.find(']', index+2)
+            if index == -1:
+                return []
+        elif char == '(':
+            end_run()
+            groups.append(len(literals))
+        elif char == ')':
+            end_run()
+            start = groups.pop() if groups else 0
+            if pattern[index+1:index+2] in ('*', '?', '{'):
+                del literals[start:]
+                index += 1
+                if pattern[index] == '{':
+                    index = pattern.find('}', index)
+                    if index == -1:
+                        return []
+        elif char in '.^$+':
+            end_run()
+        else:
+            current.append(char)
+        index += 1
+    end_run()
+    return literals
+
+
+class TrigramIndex:
+    """Trigrams of every file in one directory, so grep can skip files that can't contain a match.
+
+    Files are only marked stale when they change (see Computer.node_changed), and are re-read
+    the next time the directory is searched."""
+    def __init__(self):
+        self.postings = collections.defaultdict(set)  # Trigram -> names of files containing it
+        self.files = {}  # Name -> trigrams of that file
+        self.stale = set()
+        self.size = None  # Directory length when last refreshed, a mismatch means changes were missed
+
+    def refresh(self, folder):
+        if self.size != len(folder):
+            self.stale.update(folder)
+            self.stale.update(self.files)
+        for name in self.stale:
+            for trigram in self.files.pop(name, ()):
+                self.postings[trigram].discard(name)
+            node = folder.get(name)
+            if filesystem.is_file(node):
+                text = str(node)
+                trigrams = self.files[name] = {text[index:index+3] for index in range(len(text)-2)}
+                for trigram in trigrams:
+                    self.postings[trigram].add(name)
+        self.stale.clear()
+        self.size = len(folder)
+
+    def candidates(self, folder, trigrams):
+        """Names of the files in folder that contain all of trigrams"""
+        self.refresh(folder)
+        names = None
+        for trigram in sorted(trigrams, key=lambda _: len(self.postings.get(_, ()))):
+            postings = self.postings.get(trigram, set())
+            names = postings.copy() if names is None else names & postings
+            if not names:
+                break
+        return names
+
+
+def tokenize(text):
+    return set(token_expression.findall(text.lower()))
+
+
+class SearchIndex:
+    """Inverted index from words to the paths of files with the word in their path ('name') or content ('content').
+
+    Writes only mark paths as stale (see Computer.node_changed). Stale paths are re-read before the next
+    lookup or save, and only the files that changed are rewritten in the save file."""
+    def __init__(self):
+        self.postings = {'name': collections.defaultdict(set), 'content': collections.defaultdict(set)}
+        self.files = {}  # Path -> {'name': tokens, 'content': tokens}
+        self.directories = set()  # Indexed directory paths, whose files are dropped along with them
+        self.stale = set()
+        self.changed = set()  # File paths whose saved rows are out of date
+        self.ready = False  # Set once the index has been built or loaded
+
+    def mark(self, path):
+        self.stale.add(path)
+
+    def build(self):
+        # Index the whole drive on the next refresh
+        self.stale = {'/'}
+        self.ready = True
+
+    def load(self, rows):
+        for path, kind, token in rows:
+            if path not in self.files:
+                self.files[path] = {'name': set(), 'content': set()}
+                self.directories.update(parent_paths(path))
+            self.files[path][kind].add(token)
+            self.postings[kind][token].add(path)
+        self.ready = True
+
+    def refresh(self, lookup, hydrate):
+        # Swapped out first, sessions in other threads may mark more paths while this runs
+        stale, self.stale = self.stale, set()
+        for path in stale:
+            self.remove(path)
+            node = lookup(path)
+            if node is not None:
+                self.add(path, node, hydrate)
+
+    def remove(self, path):
+        paths = [path]
+        if path in self.directories:
+            prefix = path.rstrip('/') + '/'
+            paths += [_ for _ in self.files if _.startswith(prefix)]
+            self.directories = {_ for _ in self.directories if _ != path and not _.startswith(prefix)}
+        for curr_path in paths:
+            tokens = self.files.pop(curr_path, None)
+            if tokens is not None:
+                self.changed.add(curr_path)
+                for kind in tokens:
+                    for token in tokens[kind]:
+                        self.postings[kind][token].discard(curr_path)
+
+    def add(self, path, node, hydrate):
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            if filesystem.is_dir(node):
+                hydrate(node)
+                self.directories.add(path)
+                stack.extend((persistence.child_path(path, name), child) for name, child in node.items())
+            elif filesystem.is_file(node):
+                tokens = self.files[path] = {'name': tokenize(path), 'content': tokenize(str(node))}
+                self.changed.add(path)
+                for kind in tokens:
+                    for token in tokens[kind]:
+                        self.postings[kind][token].add(path)
+
+    def lookup(self, words, kinds=('name', 'content')):
+        """Sorted paths of the files that have every word in one of kinds"""
+        paths = None
+        for word in words:
+            for token in tokenize(word) or {word.lower()}:
+                matches = set().union(*[self.postings[kind].get(token, ()) for kind in kinds])
+                paths = matches if paths is None else paths & matches
+        return sorted(paths or ())
+
+    def take_changes(self):
+        changed, self.changed = self.changed, set()
+        return [(path, [(path, kind, token) for kind, tokens in self.files[path].items() for token in tokens]
+                 if path in self.files else []) for path in changed]
+
+
+def parent_paths(path):
+    while path != '/':
+        path = path.rpartition('/')[0] or '/'
+        yield path
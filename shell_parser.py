@@ -0,0 +1,216 @@
+import functools
+import re
+
+# Runs of characters that never have a special meaning, consumed in one step by the lexer
+literal_expression = re.compile(r'[^;|>$(\'"\[\]]+')
+word_expression = re.compile(r'\w+')
+command_name_expression = re.compile(r'\s*(\w*)')
+
+
+class Substitution:
+    def __init__(self, kind, text):
+        self.kind = kind  # 'variable', 'command' (${...}) or 'arithmetic' ((...))
+        self.text = text
+
+
+class Redirect:
+    def __init__(self, mode, target):
+        self.mode = mode  # 'file' appends (>>), 'file_overwrite' replaces (>)
+        self.target = target
+
+
+class Command:
+    def __init__(self, name, parts, redirect=None):
+        # Leading word of the command, parts are literal strings and Substitutions making up the whole command line
+        self.name = name
+        self.parts = parts
+        self.redirect = redirect
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+
+
+class Sequence:
+    def __init__(self, pipelines):
+        self.pipelines = pipelines
+
+
+class Lexer:
+    def __init__(self, line):
+        self.line = line
+        self.pos = 0
+
+    def peek(self, offset=0):
+        try:
+            return self.line[self.pos+offset]
+        except IndexError:
+            return ''
+
+    def parse_sequence(self):
+        pipelines = []
+        while True:
+            pipeline = self.parse_pipeline()
+            # Empty commands between separators, e.g. a trailing ;, are dropped
+            if len(pipeline.stages) > 1 or pipeline.stages[0].parts or pipeline.stages[0].redirect:
+                pipelines.append(pipeline)
+            if self.peek() != ';':
+                break
+            self.pos += 1
+        if not pipelines:
+            pipelines.append(Pipeline([Command('', [])]))
+        return Sequence(pipelines)
+
+    def parse_pipeline(self):
+        stages = [self.parse_command()]
+        while self.peek() == '|':
+            self.pos += 1
+            stages.append(self.parse_command())
+        return Pipeline(stages)
+
+    def parse_command(self):
+        name = command_name_expression.match(self.line, self.pos).group(1)
+        if name == 'if':
+            # Conditions and branches are evaluated by do_if itself, so only ; ends the command
+            parts = self.parse_parts(separators=';', substitute=False)
+            return Command(name, strip_parts(parts))
+        elif name == 'let':
+            # Variables stay as slots for the expression compiler and comparisons can't be redirects
+            parts = self.parse_parts(separators=';', keep_variables=True)
+            return Command(name, strip_parts(parts))
+        parts = self.parse_parts(raw_quote=(name == 'raw'))
+        redirect = None
+        if self.peek() == '>':
+            if self.peek(1) == '>':
+                mode = 'file'
+                self.pos += 2
+            else:
+                mode = 'file_overwrite'
+                self.pos += 1
+            redirect = Redirect(mode, strip_parts(self.parse_parts(separators=';|>')))
+        return Command(name, strip_parts(parts), redirect)
+
+    def parse_parts(self, separators=';|>', substitute=True, keep_variables=False, raw_quote=False):
+        line = self.line
+        end = len(line)
+        parts = []
+        buffer = []
+        quote = None
+        bracket_depth = 0
+        while self.pos < end:
+            char = line[self.pos]
+            if quote:
+                if char == quote:
+                    quote = None
+            elif char in separators:
+                if char == '|' and self.peek(1) == '|':
+                    buffer.append('||')
+                    self.pos += 2
+                    continue
+                if bracket_depth == 0 or char == ';':
+                    break
+            elif char == '[':
+                bracket_depth += 1
+            elif char == ']':
+                bracket_depth = max(0, bracket_depth-1)
+            elif char == '"' or char == "'":
+                close = line.find(char, self.pos+1)
+                if raw_quote and char == '"' and close != -1:
+                    # The first quoted string given to raw is passed on untouched and without its quotes
+                    buffer.append(line[self.pos+1:close])
+                    self.pos = close + 1
+                    raw_quote = False
+                    continue
+                if close != -1:
+                    quote = char
+            if substitute and char == '$':
+                if self.peek(1) == '{':
+                    close = find_closing(line, self.pos+1, '{', '}')
+                    if close != -1:
+                        flush_buffer(buffer, parts)
+                        parts.append(Substitution('command', line[self.pos+2:close]))
+                        self.pos = close + 1
+                        continue
+                else:
+                    word = word_expression.match(line, self.pos+1)
+                    if word:
+                        if keep_variables:
+                            buffer.append(line[self.pos:word.end()])
+                        else:
+                            flush_buffer(buffer, parts)
+                            parts.append(Substitution('variable', '$'+word.group(0)))
+                        self.pos = word.end()
+                        continue
+            elif substitute and char == '(' and self.peek(1) == '(':
+                close = find_closing(line, self.pos, '(', ')')
+                if close != -1 and line[close-1] == ')':
+                    flush_buffer(buffer, parts)
+                    parts.append(Substitution('arithmetic', line[self.pos+2:close-1].strip()))
+                    self.pos = close + 1
+                    continue
+            literal = literal_expression.match(line, self.pos+1)
+            if literal:
+                buffer.append(line[self.pos:literal.end()])
+                self.pos = literal.end()
+            else:
+                buffer.append(char)
+                self.pos += 1
+        flush_buffer(buffer, parts)
+        return parts
+
+
+def flush_buffer(buffer, parts):
+    if buffer:
+        parts.append(''.join(buffer))
+        buffer.clear()
+
+
+def find_closing(line, start, opening, closing):
+    # Index of the bracket closing the one at start, or -1 if it is never closed
+    depth = 0
+    for index in range(start, len(line)):
+        if line[index] == opening:
+            depth += 1
+        elif line[index] == closing:
+            depth -= 1
+            if depth == 0:
+                return index
+    return -1
+
+
+def strip_parts(parts):
+    if parts and type(parts[0]) == str:
+        parts[0] = parts[0].lstrip()
+        if not parts[0]:
+            parts.pop(0)
+    if parts and type(parts[-1]) == str:
+        parts[-1] = parts[-1].rstrip()
+        if not parts[-1]:
+            parts.pop()
+    return parts
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(line):
+    """Parse a command line into a Sequence of Pipelines of Commands"""
+    return Lexer(line).parse_sequence()
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_word(text, keep_variables=False):
+    """Parse text with no command separators into parts, for expansion on its own"""
+    return Lexer(text).parse_parts(separators='', keep_variables=keep_variables)
+
+
+def split_statements(line):
+    """Text of each command in line, split at the ;s that parse would split it at"""
+    lexer = Lexer(line)
+    statements = []
+    while True:
+        start = lexer.pos
+        lexer.parse_parts(separators=';')
+        statements.append(line[start:lexer.pos].strip())
+        if lexer.peek() != ';':
+            return [statement for statement in statements if statement]
+        lexer.pos += 1
@@ -0,0 +1,136 @@
+import collections
+import threading
+from collections.abc import Iterator
+
+
+def iter_lines(text):
+    """Yield the lines of text one at a time, without splitting the whole string up front"""
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def is_stream(output):
+    return isinstance(output, Iterator)
+
+
+def chain_lines(blocks):
+    # Blocks are either streams of lines or strings that may hold several lines each
+    for block in blocks:
+        if is_stream(block):
+            yield from chain_lines(block)
+        elif hasattr(block, 'iter_lines'):
+            yield from block.iter_lines()
+        else:
+            yield from iter_lines(str(block))
+
+
+def join(output):
+    return '\n'.join(output) if is_stream(output) else output
+
+
+class Buffer(collections.deque):
+    """Queue of input lines or command lines. Both ends take and add items in O(1), unlike a list.
+
+    capacity only limits put, which other threads (like a Router delivering messages) use to add items:
+    when the buffer is full put waits up to timeout seconds for the reader to take something. Items the
+    owning computer adds itself are always accepted, as nothing else would make space while it waits."""
+    def __init__(self, items=(), capacity=None):
+        super().__init__(items)
+        self.capacity = capacity
+        self.space = threading.Condition()
+
+    def full(self):
+        return self.capacity is not None and len(self) >= self.capacity
+
+    def put(self, item, timeout=0):
+        # Returns False if there was still no space after timeout seconds
+        if self.capacity is None:
+            self.append(item)
+            return True
+        with self.space:
+            if self.full() and not (timeout and self.space.wait_for(lambda: not self.full(), timeout)):
+                return False
+            self.append(item)
+        return True
+
+    def popleft(self):
+        item = super().popleft()
+        if self.capacity is not None:
+            with self.space:
+                self.space.notify_all()
+        return item
+
+    def pop(self, index=-1):
+        # cmd.Cmd takes queued commands with pop(0)
+        if index == 0:
+            return self.popleft()
+        elif index == -1:
+            return super().pop()
+        raise IndexError('Buffer can only pop from either end')
+
+    def clear(self):
+        super().clear()
+        with self.space:
+            self.space.notify_all()
+
+
+class LinkedBuffer:
+    """Buffer that reads from a list something else keeps adding to, like the data stream of an slink connection.
+
+    The caller's list is used as it is rather than copied, so lines added to it after connecting are still read.
+    Reading moves a cursor along the list instead of taking lines off the front, and the lines already read are
+    only cut off once they make up half the list, so popleft is O(1) on average. capacity works as for Buffer."""
+    def __init__(self, lines, capacity=None):
+        self.data = lines
+        self.start = 0  # Index of the next line to read
+        self.capacity = capacity
+        self.space = threading.Condition()
+
+    def __len__(self):
+        return len(self.data) - self.start
+
+    def __iter__(self):
+        return iter(self.data[self.start:])
+
+    def __iadd__(self, lines):
+        self.data.extend(lines)
+        return self
+
+    def full(self):
+        return self.capacity is not None and len(self) >= self.capacity
+
+    def put(self, item, timeout=0):
+        # Returns False if there was still no space after timeout seconds
+        if self.capacity is None:
+            self.data.append(item)
+            return True
+        with self.space:
+            if self.full() and not (timeout and self.space.wait_for(lambda: not self.full(), timeout)):
+                return False
+            self.data.append(item)
+        return True
+
+    def popleft(self):
+        if not len(self):
+            raise IndexError('pop from an empty buffer')
+        item = self.data[self.start]
+        self.start += 1
+        if self.start * 2 >= len(self.data):
+            del self.data[:self.start]
+            self.start = 0
+        if self.capacity is not None:
+            with self.space:
+                self.space.notify_all()
+        return item
+
+    def clear(self):
+        self.data.clear()
+        self.start = 0
+        with self.space:
+            self.space.notify_all()
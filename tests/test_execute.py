@@ -0,0 +1,190 @@
+"""Tests that run shell commands headlessly through Computer.execute. Run from the repository root:
+    python -m pytest tests   (or python -m unittest discover tests)
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+try:
+    import external_module_repo  # noqa: F401
+except ImportError:
+    # main imports its package repository under this name, the bundled modules stand in for it
+    import modules
+    sys.modules['external_module_repo'] = modules
+
+import main  # noqa: E402
+import shell_parser  # noqa: E402
+
+
+def make_computer(drive=None, save_location=os.devnull):
+    users = {'root': {'password': 'toor', 'permissions': 'root'}, 'test': {'password': 'test', 'permissions': 'sudo'}}
+    return main.Computer(users=users, drive=drive or {'tmp': {}}, save_location=save_location)
+
+
+class ParserTest(unittest.TestCase):
+    def test_sequence_pipeline_and_redirect(self):
+        sequence = shell_parser.parse('echo a; cat /f | grep b >> /out')
+        self.assertEqual(len(sequence.pipelines), 2)
+        first, second = sequence.pipelines
+        self.assertEqual(first.stages[0].name, 'echo')
+        self.assertEqual([stage.name for stage in second.stages], ['cat', 'grep'])
+        redirect = second.stages[1].redirect
+        self.assertEqual((redirect.mode, redirect.target), ('file', ['/out']))
+
+    def test_separators_in_quotes_are_text(self):
+        computer = make_computer()
+        result = computer.execute(['echo "a; b | c > d"'])
+        self.assertEqual(result.stdout, '"a; b | c > d"')
+        self.assertNotIn('d', computer.filesystem)
+
+    def test_substitutions(self):
+        computer = make_computer()
+        result = computer.execute(['let x = 2', 'echo $x ((1 + $x)) ${pwd}'])
+        self.assertTrue(result.ok, result)
+        self.assertEqual(result.stdout, '2 3 "/"')
+
+
+class InterpreterTest(unittest.TestCase):
+    def run_script(self, script, computer=None):
+        computer = computer or make_computer()
+        computer.filesystem['tmp']['script.sh'] = script
+        result = computer.execute(['run /tmp/script.sh'])
+        self.assertTrue(result.ok, result)
+        return result
+
+    def test_goto_loop(self):
+        result = self.run_script('let i = 0\n:loop\nlet i = $i + 1\nif [ $i -lt 5 ] ? goto loop\necho $i')
+        self.assertEqual(result.stdout_lines[-1], '5')
+
+    def test_goto_and_return(self):
+        result = self.run_script('goto greet\necho back\nreturn\n:greet\necho hello\nreturn')
+        self.assertEqual(result.stdout_lines, ['hello', 'back'])
+
+    def test_for_loop(self):
+        result = self.run_script('for x in a "b c" d; do\n  echo $x\ndone')
+        # Strings from variables are quoted when expanded
+        self.assertEqual(result.stdout_lines, ['"a"', '"b c"', '"d"'])
+
+    def test_while_loop_with_break_and_continue(self):
+        result = self.run_script('let i = 0\nwhile [ $i -lt 10 ]; do\n  let i = $i + 1\n'
+                                 '  if [ $i == 2 ] ? continue\n  if [ $i == 4 ] ? break\n  echo $i\ndone')
+        self.assertEqual(result.stdout_lines, ['1', '3'])
+
+    def test_conditions(self):
+        computer = make_computer({'tmp': {'full.txt': 'abc', 'empty.txt': ''}})
+        result = computer.execute(['if [ -s /tmp/full.txt && ! -s /tmp/empty.txt ] ? echo yes : echo no',
+                                   'if [ -d /tmp/full.txt || ( -d /tmp && -e /tmp/empty.txt ) ] ? echo yes : echo no',
+                                   'if [ ${grep /tmp/full.txt -gt} ] ? echo yes : echo no'])
+        self.assertEqual(result.stdout_lines, ['yes', 'yes', 'no'])
+
+
+class GlobTest(unittest.TestCase):
+    def setUp(self):
+        self.computer = make_computer({'tmp': {'a1.txt': 'one', 'a2.txt': 'two', 'b1.txt': 'three', 'c-d': 'four'}})
+
+    def test_cat(self):
+        self.assertEqual(self.computer.execute(['cat /tmp/a*']).stdout, 'one\ntwo')
+        self.assertEqual(self.computer.execute(['cat /tmp/?1.txt']).stdout, 'one\nthree')
+        self.assertEqual(self.computer.execute(['cat /tmp/[^a]*']).stdout, 'three\nfour')
+        self.assertEqual(self.computer.execute(['cat /tmp/c[-]d']).stdout, 'four')
+
+    def test_rm(self):
+        self.assertTrue(self.computer.execute(['rm /tmp/[ab]1.txt']).ok)
+        self.assertEqual(sorted(self.computer.filesystem['tmp']), ['a2.txt', 'c-d'])
+
+
+class PersistenceTest(unittest.TestCase):
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, 'test.save')
+            computer = make_computer(save_location=location)
+            self.assertTrue(computer.execute(['mkdir /tmp/d', 'echo hello > /tmp/d/f.txt', 'let x = 3', 'cd /tmp']).ok)
+            computer.save()
+            loaded = main.Computer.load(location)
+            result = loaded.execute(['cat d/f.txt', 'echo $x'])
+            self.assertEqual(result.stdout_lines, ['hello', '3'])
+            # Only what changed since the last save is written
+            self.assertTrue(loaded.execute(['echo more >> /tmp/d/f.txt', 'rm /tmp/d/f.txt']).ok)
+            loaded.save()
+            # Directories are loaded as they are visited
+            result = main.Computer.load(location).execute(['ls /tmp', 'ls /tmp/d'])
+            self.assertTrue(result.ok, result)
+            self.assertEqual(result.stdout_lines, ['d'])
+
+    def test_empty_filesystem(self):
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, 'test.save')
+            computer = main.Computer(users={'root': {'password': 'toor', 'permissions': 'root'}}, drive={},
+                                     save_location=location)
+            computer.save()
+            self.assertEqual(dict(main.Computer.load(location).filesystem), {})
+
+
+class SessionTest(unittest.TestCase):
+    def test_contexts_are_isolated(self):
+        computer = make_computer()
+        first, second = computer.new_context(), computer.new_context()
+        computer.execute(['let x = 1', 'cd /tmp'], context=first)
+        result = computer.execute(['echo $x'], context=second)
+        self.assertEqual(result.exit_code, 'VARIABLE_NOT_FOUND_ERROR')
+        self.assertEqual(computer.execute(['pwd'], context=first).stdout, '/tmp')
+        self.assertEqual(computer.execute(['pwd'], context=second).stdout, '/')
+
+    def test_concurrent_sessions(self):
+        computer = make_computer()
+        results = {}
+
+        def session(name):
+            context = computer.new_context()
+            results[name] = computer.execute(['let n = 0', f'mkdir /tmp/{name}',
+                                              'for i in 1 2 3 4 5; do let n = $n + $i; done',
+                                              f'echo $n > /tmp/{name}/total', f'cat /tmp/{name}/total'], context=context)
+        threads = [threading.Thread(target=session, args=(f's{index}',)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name, result in results.items():
+            self.assertTrue(result.ok, result)
+            self.assertEqual(result.stdout, '15')
+        self.assertEqual(len(computer.filesystem['tmp']), 8)
+
+
+class ErrorTest(unittest.TestCase):
+    """Commands that fail return an error code in the Result instead of raising"""
+    def assert_fails(self, commands, exit_code, inputs=()):
+        result = make_computer().execute(commands, inputs)
+        self.assertEqual(result.exit_code, exit_code, result)
+        self.assertTrue(result.stderr)
+
+    def test_evaluation_errors(self):
+        self.assert_fails(['let x = 1 / 0'], 'EVALUATION_ERROR')
+        self.assert_fails(['let x = int("a")'], 'EVALUATION_ERROR')
+        self.assert_fails(['if [ 1 +* 2 ] ? echo yes'], 'INVALID_CONDITION_ERROR')
+
+    def test_missing_directories(self):
+        self.assert_fails(['run /nope/x'], 'INVALID_PATH_ERROR')
+        self.assert_fails(['rm /nope/x'], 'INVALID_PATH_ERROR')
+        self.assert_fails(['rmdir /nope/x'], 'INVALID_PATH_ERROR')
+        self.assert_fails(['echo a > /nope/f'], 'INVALID_PATH_ERROR')
+
+    def test_lined_write_to_missing_directory(self):
+        result = make_computer().execute(['lined'], inputs=['a', 'x', '.', 'w /nope/f', 'q'])
+        self.assertIn('Error - destination is not a directory', result.stderr_lines)
+
+    def test_invalid_grep_patterns(self):
+        computer = make_computer({'tmp': {'f': 'abc'}})
+        self.assertEqual(computer.execute(['grep /tmp/f [']).exit_code, 'INVALID_ARGUMENT_ERROR')
+        self.assertEqual(computer.execute(['cat /tmp/f | grep [']).exit_code, 'INVALID_ARGUMENT_ERROR')
+
+    def test_missing_input(self):
+        self.assert_fails(['read line'], 'NO_INPUT_ERROR')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+"""Tests for the filesystem nodes and glob patterns. Run from the repository root:
+    python -m pytest tests   (or python -m unittest discover tests)
+"""
+import json
+import os
+import sys
+import unittest
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import filesystem  # noqa: E402
+
+
+class ImportExportTest(unittest.TestCase):
+    def test_image_round_trip(self):
+        with open(os.path.join(repo_root, 'dooros_filesystem.json')) as f:
+            image = json.load(f)
+        self.assertEqual(filesystem.export_node(filesystem.import_node(image)), image)
+
+    def test_node_kinds(self):
+        node = filesystem.import_node({'dev': {'null': '%SPECIAL_NULL_FILE%'}, 'notes': 'a\nb', 'empty': {}})
+        self.assertIsInstance(node['dev'], filesystem.Dir)
+        self.assertTrue(filesystem.is_device(node['dev']['null'], 'null'))
+        node['log'] = filesystem.new_file('first')
+        node['log'].append('\nsecond')
+        self.assertEqual(filesystem.export_node(node), {'dev': {'null': '%SPECIAL_NULL_FILE%'}, 'notes': 'a\nb',
+                                                        'empty': {}, 'log': 'first\nsecond'})
+        self.assertEqual(json.loads(json.dumps(filesystem.export_node(node))), filesystem.export_node(node))
+
+
+if __name__ == '__main__':
+    unittest.main()